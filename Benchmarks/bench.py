@@ -0,0 +1,510 @@
+#!/usr/bin/env python3
+"""Offline benchmark of the registry and runner-info discovery/config pipelines.
+
+Everything runs on this machine: the runner fleet, the Docker Engine API and
+the Traefik REST provider are simulated by local HTTP servers, so results only
+depend on the code and the host. Each scale runs in a fresh process so memory
+numbers are not polluted by earlier runs.
+
+    python3 Benchmarks/bench.py                          # default matrix
+    python3 Benchmarks/bench.py --output baseline.json   # save for regression tracking
+    python3 Benchmarks/bench.py --compare baseline.json  # show change against a saved run
+
+The registry scenario needs the registry's dependencies (flask, flask-socketio,
+requests, pyyaml, prometheus-client), the runner-info scenario those of
+runner-info (flask, docker, requests, pyyaml, prometheus-client, waitress).
+Simulated runners listen on 127.1.x.y loopback addresses, as on Linux.
+"""
+import argparse
+import importlib.util
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import redirect_stdout
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REGISTRY_PY = os.path.join(REPO, 'Templates', 'core-template', 'registry', 'registry.py')
+RUNNER_INFO_PY = os.path.join(REPO, 'Templates', 'runner-template', 'runner-info', 'app.py')
+
+# Default matrix: registry (runners, services per runner) and runner-info services
+REGISTRY_SCALES = [(10, 10), (100, 10), (1000, 10)]
+RUNNER_INFO_SCALES = [10, 100, 1000]
+DOMAIN = "bench.local"
+DOCKER_API_VERSION = "1.41"
+
+# Metrics where lower is better, in report order
+METRICS = [
+    "cold_cycle_s", "warm_cycle_s", "churn_cycle_s", "generate_config_s",
+    "discover_s", "publish_s", "build_routing_table_s",
+    "bytes_written_cold", "bytes_written_churn", "bytes_put_traefik",
+    "state_rss_mb", "peak_rss_mb"
+]
+
+
+class QuietServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class QuietHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are separate writes; without this keep-alive clients stall on delayed ACKs
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def send_body(self, status, body, headers=None):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+
+def synthetic_service(runner, index, status="running"):
+    """A service record shaped like runner-info's, debug block included"""
+    name = f"svc{index}"
+    domain = f"{name}.{runner}.{DOMAIN}" if runner else f"{name}.{DOMAIN}"
+    return {
+        "name": name,
+        "container": f"{name}-app-1",
+        "fullDomain": domain,
+        "status": status,
+        "hosts": [domain],
+        "routerRule": f"Host(`{domain}`)",
+        "debug": {
+            "labels": {
+                f"traefik.http.routers.{name}.rule": f"Host(`{domain}`)",
+                f"traefik.http.routers.{name}.entrypoints": "web",
+                f"traefik.http.services.{name}.loadbalancer.server.port": "80",
+                "traefik.enable": "true"
+            },
+            "routers": [{"router": name, "priority": len(f"Host(`{domain}`)"), "hosts": [domain],
+                         "hostRegexps": [], "paths": [], "pathPrefixes": []}],
+            "originalDomain": domain,
+            "networks": ["bridge-network", f"{name}_default"]
+        }
+    }
+
+
+def serve_fleet(runners, services, latency, failure_rate, seed, ready):
+    """Serve /runner-info/json for every simulated runner (run in its own process).
+
+    Runner i is reached on 127.1.<i // 250>.<i % 250 + 1>; the server tells
+    runners apart by the local address a request arrived on. POST /_mutate
+    with {"fraction": f} changes one service on that fraction of runners.
+    """
+    rng = random.Random(seed)
+    lock = threading.Lock()
+    docs = {}
+    statuses = {}
+
+    def render(ip):
+        state = statuses[ip]
+        body = json.dumps({
+            "runner": state["runner"],
+            "domain": f"{state['runner']}.{DOMAIN}" if state["runner"] else DOMAIN,
+            "services": [synthetic_service(state["runner"], j, s) for j, s in enumerate(state["services"])],
+            "last_updated": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "version": state["version"],
+            "epoch": "bench"
+        }).encode()
+        docs[ip] = (body, f'"{state["version"]}-{hash(body) & 0xffffffff:x}"')
+
+    for i in range(runners):
+        ip = f"127.1.{i // 250}.{i % 250 + 1}"
+        statuses[ip] = {"runner": f"r{i}", "version": 1, "services": ["running"] * services}
+        render(ip)
+
+    class Handler(QuietHandler):
+        def do_POST(self):
+            request = json.loads(self.read_body() or b'{}')
+            with lock:
+                for ip in rng.sample(sorted(statuses), max(1, int(len(statuses) * request.get('fraction', 0.1)))):
+                    state = statuses[ip]
+                    j = rng.randrange(len(state["services"])) if state["services"] else None
+                    if j is not None:
+                        state["services"][j] = "exited" if state["services"][j] == "running" else "running"
+                    state["version"] += 1
+                    render(ip)
+            self.send_body(200, b'{}', {'Content-Type': 'application/json'})
+
+        def do_GET(self):
+            ip = self.connection.getsockname()[0]
+            if latency:
+                time.sleep(latency)
+            with lock:
+                failed = rng.random() < failure_rate
+                body, etag = docs.get(ip, (None, None))
+            if body is None or failed:
+                self.send_body(500, b'', {'Content-Type': 'text/plain'})
+            elif self.headers.get('If-None-Match') == etag:
+                self.send_body(304, b'', {'ETag': etag})
+            else:
+                self.send_body(200, body, {'Content-Type': 'application/json', 'ETag': etag})
+
+    server = QuietServer(('0.0.0.0', 0), Handler)
+    ready.send(server.server_address[1])
+    server.serve_forever()
+
+
+def serve_docker(services, seed, ready):
+    """Minimal Docker Engine API for runner-info: version, container list and inspect"""
+    rng = random.Random(seed)
+    lock = threading.Lock()
+    containers = {}
+    for j in range(services):
+        service = synthetic_service("", j)
+        containers[f"{j:064x}"] = {
+            "name": service["container"],
+            "status": "running",
+            "labels": dict(service["debug"]["labels"], **{
+                "com.runner.service.type": "entry-point",
+                "com.runner.service.name": service["name"]
+            }),
+            "ip": f"172.20.{j // 250}.{j % 250 + 2}"
+        }
+
+    def inspect(container_id):
+        c = containers[container_id]
+        return {
+            "Id": container_id,
+            "Name": "/" + c["name"],
+            "Config": {"Labels": c["labels"]},
+            "State": {"Status": c["status"]},
+            "NetworkSettings": {"Networks": {"bridge-network": {"IPAddress": c["ip"]}}}
+        }
+
+    class Handler(QuietHandler):
+        def reply(self, document):
+            self.send_body(200, json.dumps(document).encode(), {'Content-Type': 'application/json'})
+
+        def do_POST(self):
+            request = json.loads(self.read_body() or b'{}')
+            with lock:
+                for container_id in rng.sample(sorted(containers), max(1, int(len(containers) * request.get('fraction', 0.1)))):
+                    c = containers[container_id]
+                    c["status"] = "exited" if c["status"] == "running" else "running"
+            self.reply({})
+
+        def do_GET(self):
+            path = self.path.split('?')[0]
+            parts = path.strip('/').split('/')
+            if parts and parts[0].startswith('v1.'):
+                parts = parts[1:]
+            with lock:
+                if parts == ['version']:
+                    self.reply({"ApiVersion": DOCKER_API_VERSION, "MinAPIVersion": "1.12", "Version": "bench"})
+                elif parts == ['containers', 'json']:
+                    self.reply([{"Id": cid, "Names": ["/" + c["name"]], "Labels": c["labels"], "State": c["status"],
+                                 "NetworkSettings": {"Networks": {"bridge-network": {"IPAddress": c["ip"]}}}}
+                                for cid, c in containers.items()])
+                elif len(parts) == 3 and parts[0] == 'containers' and parts[2] == 'json' and parts[1] in containers:
+                    self.reply(inspect(parts[1]))
+                else:
+                    self.send_body(404, b'{"message": "not found"}', {'Content-Type': 'application/json'})
+
+    server = QuietServer(('127.0.0.1', 0), Handler)
+    ready.send(server.server_address[1])
+    server.serve_forever()
+
+
+def serve_traefik(ready):
+    """Traefik API stand-in: accepts REST provider PUTs and counts their bytes (GET /_bench)"""
+    received = {"puts": 0, "bytes": 0}
+
+    class Handler(QuietHandler):
+        def do_PUT(self):
+            received["puts"] += 1
+            received["bytes"] += len(self.read_body())
+            self.send_body(200, b'', {'Content-Type': 'text/plain'})
+
+        def do_GET(self):
+            body = json.dumps(received if self.path == '/_bench' else []).encode()
+            self.send_body(200, body, {'Content-Type': 'application/json'})
+
+    server = QuietServer(('127.0.0.1', 0), Handler)
+    ready.send(server.server_address[1])
+    server.serve_forever()
+
+
+def start_server(target, *args):
+    """Run a simulator in its own process so it does not count towards our memory"""
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=target, args=args + (sender,), daemon=True)
+    process.start()
+    return process, receiver.recv()
+
+
+def post(url, document):
+    import requests
+    requests.post(url, json=document, timeout=30).raise_for_status()
+
+
+def load_module(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def rss_mb():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def timed(function, *args):
+    started = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - started, result
+
+
+def median_time(repeat, function, *args):
+    return statistics.median(timed(function, *args)[0] for _ in range(repeat))
+
+
+def bench_registry(runners, services, args):
+    """Discovery cycles and config generation of the registry against a simulated fleet"""
+    fleet, fleet_port = start_server(serve_fleet, runners, services, args.latency, args.failure_rate, args.seed)
+    work = tempfile.mkdtemp(prefix='bench-registry-')
+    endpoints_file = os.path.join(work, 'endpoints.json')
+    with open(endpoints_file, 'w') as f:
+        json.dump([{"id": str(i), "ip": f"127.1.{i // 250}.{i % 250 + 1}:{fleet_port}", "description": ""}
+                   for i in range(runners)], f)
+    os.environ.update(ENDPOINTS_FILE=endpoints_file,
+                      STATE_FILE=os.path.join(work, 'state.json'),
+                      OUTPUT_DIR=os.path.join(work, 'output'),
+                      ACCESS_LOG_FILE='')
+
+    registry = load_module('registry', REGISTRY_PY)
+    os.makedirs(registry.OUTPUT_DIR, exist_ok=True)
+    import_rss = rss_mb()
+
+    # Count what reaches the disk
+    written = {"bytes": 0}
+    atomic_write = registry.atomic_write
+
+    def counting_write(path, data):
+        written["bytes"] += len(data)
+        return atomic_write(path, data)
+    registry.atomic_write = counting_write
+
+    def cycle():
+        return registry.run_refresh_cycle({"reasons": ["benchmark"]})
+
+    metrics = {}
+    metrics["cold_cycle_s"], found = timed(cycle)
+    metrics["bytes_written_cold"] = written["bytes"]
+    metrics["warm_cycle_s"] = median_time(args.repeat, cycle)
+
+    churn_times = []
+    written["bytes"] = 0
+    for _ in range(args.repeat):
+        post(f"http://127.0.0.1:{fleet_port}/_mutate", {"fraction": args.churn})
+        churn_times.append(timed(cycle)[0])
+    metrics["churn_cycle_s"] = statistics.median(churn_times)
+    metrics["bytes_written_churn"] = written["bytes"] // args.repeat
+
+    with registry.state_lock:
+        metrics["generate_config_s"] = median_time(args.repeat, registry.generate_config, registry.discovered_runners)
+    metrics["runners_found"] = found
+    metrics["state_rss_mb"] = rss_mb() - import_rss
+    metrics["peak_rss_mb"] = peak_rss_mb()
+    fleet.terminate()
+    return metrics
+
+
+def bench_runner_info(services, args):
+    """Docker discovery and routing publication of runner-info against a fake Docker API"""
+    docker_api, docker_port = start_server(serve_docker, services, args.seed)
+    traefik, traefik_port = start_server(serve_traefik)
+    work = tempfile.mkdtemp(prefix='bench-runner-info-')
+    os.environ.update(DOCKER_HOST=f"tcp://127.0.0.1:{docker_port}",
+                      TRAEFIK_API=f"http://127.0.0.1:{traefik_port}",
+                      ROUTING_FILE=os.path.join(work, 'services-generated.yml'),
+                      STATE_FILE=os.path.join(work, 'state.json'),
+                      REGISTRY_URL='')
+
+    runner_info = load_module('runner_info', RUNNER_INFO_PY)
+    import_rss = rss_mb()
+
+    def discover():
+        discovered, ips = runner_info.discover_service_map()
+        with runner_info.service_map_lock:
+            runner_info.service_map = discovered
+            runner_info.container_ips = ips
+        return discovered
+
+    metrics = {}
+    metrics["discover_s"], discovered = timed(discover)
+    metrics["cold_cycle_s"] = metrics["discover_s"] + timed(runner_info.publish_services, True)[0]
+    metrics["bytes_written_cold"] = os.path.getsize(runner_info.ROUTING_FILE)
+    metrics["warm_cycle_s"] = median_time(args.repeat, lambda: (discover(), runner_info.publish_services(False)))
+
+    churn_times = []
+    for _ in range(args.repeat):
+        post(f"http://127.0.0.1:{docker_port}/_mutate", {"fraction": args.churn})
+        churn_times.append(timed(lambda: (discover(), runner_info.publish_services(False)))[0])
+    metrics["churn_cycle_s"] = statistics.median(churn_times)
+    metrics["bytes_written_churn"] = os.path.getsize(runner_info.ROUTING_FILE)
+
+    # A full reconciliation re-emits to the REST sink even when unchanged
+    metrics["publish_s"] = median_time(args.repeat, runner_info.publish_services, True)
+    metrics["build_routing_table_s"] = median_time(args.repeat, runner_info.build_routing_table, runner_info.services)
+    import requests
+    metrics["bytes_put_traefik"] = requests.get(f"http://127.0.0.1:{traefik_port}/_bench", timeout=5).json()["bytes"]
+    metrics["services_found"] = len(discovered)
+    metrics["state_rss_mb"] = rss_mb() - import_rss
+    metrics["peak_rss_mb"] = peak_rss_mb()
+    docker_api.terminate()
+    traefik.terminate()
+    return metrics
+
+
+def run_child(args):
+    """Run one scale in this process and print its metrics as JSON"""
+    out = sys.stdout
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        if args.child == 'registry':
+            metrics = bench_registry(args.runners, args.services, args)
+        else:
+            metrics = bench_runner_info(args.services, args)
+    out.write(json.dumps(metrics) + "\n")
+
+
+def child_command(args, scenario, runners, services):
+    return [sys.executable, os.path.abspath(__file__), '--child', scenario,
+            '--runners', str(runners), '--services', str(services),
+            '--repeat', str(args.repeat), '--churn', str(args.churn),
+            '--latency', str(args.latency), '--failure-rate', str(args.failure_rate),
+            '--seed', str(args.seed)]
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', '-C', REPO, 'rev-parse', '--short', 'HEAD'],
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def format_value(metric, value):
+    if value is None:
+        return "-"
+    if metric.endswith('_s'):
+        return f"{value * 1000:.1f}ms"
+    if metric.startswith('bytes'):
+        return f"{value / 1024:.1f}KiB"
+    if metric.endswith('_mb'):
+        return f"{value:.1f}MB"
+    return str(value)
+
+
+def result_key(result):
+    return (result["scenario"], result["runners"], result["services"])
+
+
+def print_report(results, baseline=None):
+    previous = {result_key(r): r["metrics"] for r in (baseline or {}).get("results", [])}
+    for result in results:
+        print(f"\n{result['scenario']}: {result['runners']} runners x {result['services']} services")
+        if "error" in result:
+            print(f"  failed: {result['error']}")
+            continue
+        before = previous.get(result_key(result), {})
+        for metric in METRICS:
+            if metric not in result["metrics"]:
+                continue
+            value = result["metrics"][metric]
+            line = f"  {metric:24} {format_value(metric, value):>12}"
+            if before.get(metric):
+                line += f"  ({(value - before[metric]) / before[metric] * 100:+.1f}% vs baseline)"
+            print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenario', choices=['all', 'registry', 'runner-info'], default='all')
+    parser.add_argument('--registry-scales', default=','.join(f"{r}x{s}" for r, s in REGISTRY_SCALES),
+                        help="comma separated RUNNERSxSERVICES for the registry")
+    parser.add_argument('--runner-info-scales', default=','.join(map(str, RUNNER_INFO_SCALES)),
+                        help="comma separated service counts for runner-info")
+    parser.add_argument('--repeat', type=int, default=5, help="runs per measurement, the median is reported")
+    parser.add_argument('--churn', type=float, default=0.1, help="fraction of runners/containers changed per churn cycle")
+    parser.add_argument('--latency', type=float, default=0.005, help="seconds each simulated runner takes to answer")
+    parser.add_argument('--failure-rate', type=float, default=0.0, help="fraction of runner requests answered with HTTP 500")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="write results as JSON to this file")
+    parser.add_argument('--compare', help="JSON results of an earlier run to compare against")
+    parser.add_argument('--child', choices=['registry', 'runner-info'], help=argparse.SUPPRESS)
+    parser.add_argument('--runners', type=int, default=1, help=argparse.SUPPRESS)
+    parser.add_argument('--services', type=int, default=10, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args)
+        return
+
+    plan = []
+    if args.scenario in ('all', 'registry'):
+        for scale in args.registry_scales.split(','):
+            runners, services = scale.split('x')
+            plan.append(('registry', int(runners), int(services)))
+    if args.scenario in ('all', 'runner-info'):
+        plan += [('runner-info', 1, int(services)) for services in args.runner_info_scales.split(',')]
+
+    results = []
+    for scenario, runners, services in plan:
+        print(f"Running {scenario} with {runners} runners x {services} services...", file=sys.stderr)
+        result = {"scenario": scenario, "runners": runners, "services": services}
+        process = subprocess.run(child_command(args, scenario, runners, services), capture_output=True, text=True)
+        if process.returncode == 0:
+            result["metrics"] = json.loads(process.stdout.strip().splitlines()[-1])
+        else:
+            result["error"] = (process.stderr.strip().splitlines() or ["exit code %d" % process.returncode])[-1]
+        results.append(result)
+
+    report = {
+        "meta": {
+            "revision": git_revision(),
+            "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "settings": {key: getattr(args, key) for key in ('repeat', 'churn', 'latency', 'failure_rate', 'seed')}
+        },
+        "results": results
+    }
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(results, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nResults written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
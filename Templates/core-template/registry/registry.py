@@ -3,19 +3,120 @@ import requests
 import json
 import time
 import os
+import logging
 import yaml
 import threading
 import uuid
-from flask import Flask, jsonify, render_template, request, redirect, url_for, abort
-from flask_socketio import SocketIO
+import hashlib
+import math
+import re
+import tempfile
+import random
+import socket
+import sys
+import queue
+import fcntl
+from contextlib import contextmanager
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeoutError
+from requests.adapters import HTTPAdapter
+from flask import Flask, Response, jsonify, render_template, request, redirect, url_for, abort
+from flask_socketio import SocketIO, emit
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
+
+try:
+    import runlog
+except ImportError:
+    # Running from a checkout, where the shared modules live in Templates/shared
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir, 'shared'))
+    import runlog
+
+# Use the libyaml-backed dumper when PyYAML was built with it
+try:
+    from yaml import CSafeDumper as YamlDumper
+except ImportError:
+    from yaml import SafeDumper as YamlDumper
 
 # Read domain from environment or use default
 DOMAIN_BASE = os.environ.get('DOMAIN_BASE', 'preview.tafu.casa')
 
 # File to store endpoints
-ENDPOINTS_FILE = "/app/data/endpoints.json"
-OUTPUT_DIR = "/output"
-POLLING_INTERVAL = 30  # seconds
+ENDPOINTS_FILE = os.environ.get('ENDPOINTS_FILE', "/app/data/endpoints.json")
+ENDPOINTS_RECHECK_INTERVAL = 2  # seconds between mtime checks of ENDPOINTS_FILE
+# Last successfully generated runner state, restored on startup
+STATE_FILE = os.environ.get('STATE_FILE', "/app/data/state.json")
+STATE_SAVE_INTERVAL = float(os.environ.get('STATE_SAVE_INTERVAL', '5'))  # seconds, STATE_FILE is written at most this often
+OUTPUT_DIR = os.environ.get('OUTPUT_DIR', "/output")
+SHARD_PREFIX = "runner-"  # one dynamic config file per runner: runner-<name>.yml
+LEGACY_OUTPUT_FILE = "services.yml"
+SHARED_SHARD = "shared-hosts.yml"  # hosts served by more than one runner
+
+# Health checks for hosts load balanced across several runners, off unless a path is set
+HEALTHCHECK_PATH = os.environ.get('HEALTHCHECK_PATH', '')  # e.g. /healthz, must answer 2xx/3xx on every runner
+HEALTHCHECK_INTERVAL = os.environ.get('HEALTHCHECK_INTERVAL', '10s')
+HEALTHCHECK_TIMEOUT = os.environ.get('HEALTHCHECK_TIMEOUT', '3s')
+# Routing table changes kept for /api/routes?since=
+ROUTING_JOURNAL_SIZE = int(os.environ.get('ROUTING_JOURNAL_SIZE', '10000'))
+POLLING_INTERVAL = 30  # seconds, base per-endpoint polling interval
+# Runners that push deltas to /api/ingest are only polled this often, as a safety net
+PUSH_POLL_INTERVAL = int(os.environ.get('PUSH_POLL_INTERVAL', '120'))  # seconds
+INGEST_QUEUE_SIZE = int(os.environ.get('INGEST_QUEUE_SIZE', '1000'))  # accepted deltas waiting to be applied
+
+# Adaptive per-endpoint polling
+POLL_TICK = 5  # seconds between checks for endpoints that are due
+FAST_POLL_INTERVAL = 10  # seconds, for endpoints that changed recently
+SLOW_POLL_INTERVAL = 120  # seconds, for endpoints stable for a long time
+RECENT_CHANGE_WINDOW = 120  # seconds after a change during which an endpoint is polled fast
+STABLE_AFTER = 900  # seconds without a change after which an endpoint is polled slowly
+MAX_BACKOFF = 300  # seconds, cap on the retry interval of failing endpoints
+CIRCUIT_FAILURE_THRESHOLD = 3  # consecutive failures that open an endpoint's circuit
+POLL_JITTER = 0.2  # +/- fraction applied to every interval
+REFRESH_DEBOUNCE = float(os.environ.get('REFRESH_DEBOUNCE', '1'))  # seconds of quiet before a triggered cycle
+REFRESH_MAX_DELAY = float(os.environ.get('REFRESH_MAX_DELAY', '5'))  # seconds a trigger may be postponed at most
+REFRESH_HISTORY = 100  # finished cycles kept for /api/refresh/<id>
+
+# Discovery tuning: runners are polled concurrently over a shared keep-alive pool
+DISCOVERY_WORKERS = int(os.environ.get('DISCOVERY_WORKERS', '32'))
+ENDPOINT_CONNECT_TIMEOUT = float(os.environ.get('ENDPOINT_CONNECT_TIMEOUT', '2'))  # seconds
+ENDPOINT_READ_TIMEOUT = float(os.environ.get('ENDPOINT_READ_TIMEOUT', '5'))  # seconds
+CYCLE_DEADLINE = float(os.environ.get('CYCLE_DEADLINE', '20'))  # seconds, bound for a whole cycle
+
+# Service detail pages older than this trigger a background refresh of their runner
+SERVICE_DETAIL_MAX_AGE = SLOW_POLL_INTERVAL * 2  # seconds
+# Full debug blocks (Traefik labels, networks) are fetched from runner-info when a
+# detail page or the debug API asks, and kept for this many runners for this long
+DEBUG_CACHE_SIZE = 64
+DEBUG_CACHE_SECONDS = 60  # seconds
+
+# /api/load reuses the resource stats fetched from the runners for this long
+LOAD_CACHE_SECONDS = 10  # seconds
+
+# Replication: several registries on one data volume and /output. Each polls the
+# endpoints it owns (rendezvous hashing over the live replicas) and shares what it
+# found under REPLICA_DIR; only the holder of the leader lease writes Traefik config
+REPLICATION = os.environ.get('REPLICATION', 'false').lower() in ('1', 'true', 'yes')
+REGISTRY_PORT = int(os.environ.get('REGISTRY_PORT', '5000'))
+REPLICA_ID = os.environ.get('REPLICA_ID') or f"{socket.gethostname()}-{os.getpid()}"
+# How the other replicas reach this one, for forwarding pushed deltas
+REPLICA_URL = os.environ.get('REPLICA_URL') or f"http://{socket.gethostname()}:{REGISTRY_PORT}"
+REPLICA_DIR = os.environ.get('REPLICA_DIR', "/app/data/replicas")
+REPLICA_HEARTBEAT = 2  # seconds between heartbeats and lease renewals
+REPLICA_TTL = 10  # seconds without a heartbeat after which a replica is gone
+# Kept out of OUTPUT_DIR so renewals don't wake Traefik's file watcher
+LEADER_LEASE_FILE = os.path.join(REPLICA_DIR, "leader.json")
+LEADER_LEASE_TTL = 10  # seconds a lease lasts without renewal, rewritten once half of it is left
+
+# Traffic analytics from the edge Traefik's JSON access log (empty path disables them)
+ACCESS_LOG_FILE = os.environ.get('ACCESS_LOG_FILE', '/var/log/traefik/access.log')
+ACCESS_LOG_CHUNK = 1 << 20  # bytes read from the access log at a time
+ACCESS_LOG_IDLE = 0.5  # seconds to wait for new lines at the end of the log
+ACCESS_BUCKET_SECONDS = 10  # width of one sliding-window bucket
+ACCESS_WINDOW_BUCKETS = 90  # buckets kept per host, i.e. the longest window (15 minutes)
+ACCESS_WINDOWS = {"1m": 60, "5m": 300, "15m": 900}  # windows reported by /api/traffic
+ACCESS_MAX_HOSTS = int(os.environ.get('ACCESS_MAX_HOSTS', '5000'))  # hosts tracked before folding into OTHER_HOST
+ACCESS_HOST_CACHE = 10000  # access log hosts whose lookup_host() result is remembered
+ACCESS_LATENCY_GAMMA = 1.05  # ratio between latency bins, i.e. percentiles within ~2.5%
+OTHER_HOST = "_other"  # requests for hosts that are not a known service
 
 # Ensure data directory exists
 os.makedirs(os.path.dirname(ENDPOINTS_FILE), exist_ok=True)
@@ -26,35 +127,492 @@ DEFAULT_ENDPOINTS = [
     {"id": str(uuid.uuid4()), "ip": "192.168.3.226", "description": "Staging runner"}
 ]
 
+# Metrics exposed on /metrics
+ENDPOINT_FETCH_SECONDS = Histogram('registry_endpoint_fetch_seconds',
+                                   'Time to poll a runner endpoint', ['endpoint'],
+                                   buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+ENDPOINT_FETCH_ERRORS = Counter('registry_endpoint_fetch_errors_total',
+                                'Failed runner endpoint polls', ['endpoint'])
+DISCOVERY_CYCLE_SECONDS = Histogram('registry_discover_runners_seconds',
+                                    'Duration of a discover_runners cycle',
+                                    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 20, 30, 60))
+CONFIG_BUILD_SECONDS = Histogram('registry_generate_config_build_seconds',
+                                 'Time to build the Traefik config in generate_config')
+CONFIG_WRITE_SECONDS = Histogram('registry_generate_config_write_seconds',
+                                 'Time to serialize and write the Traefik config in generate_config')
+ROUTES_EMITTED = Gauge('registry_routes', 'Routes in the generated Traefik config')
+SOCKETIO_CLIENTS = Gauge('registry_socketio_clients', 'Connected Socket.IO clients')
+ACCESS_LOG_LINES = Counter('registry_access_log_lines_total', 'Access log lines ingested')
+ACCESS_LOG_ERRORS = Counter('registry_access_log_parse_errors_total', 'Access log lines that could not be parsed')
+
+# Logging is configured from LOG_LEVEL, LOG_FORMAT and the other LOG_* variables, see runlog
+runlog.configure()
+log = logging.getLogger('registry')
+
 # Global state
 discovered_runners = []
 last_updated = None
+discovery_changed = True  # whether the last discovery cycle changed any runner
+last_cycle_full = False  # whether the last discovery cycle polled every endpoint
+config_dirty = True  # set when config must be regenerated even if no runner changed
+state_stale = False  # True while serving state restored from STATE_FILE
+# Runners behind the current config, persisted to STATE_FILE by state_saver_thread()
+state_runners = None
+state_save_requested = threading.Event()
+
+# Runners in the last generated config, keyed by ip, and the ips among them that
+# dropped out of discovery but are kept until a full cycle confirms they are gone
+written_runners = {}
+pending_shrink = set()
+# Endpoints we own whose runner failed again in a full cycle after an earlier
+# failure: confirmed gone, published in our shard for the leader's guard_shrink
+confirmed_gone = set()
+
+# Service path (as linked from the dashboard) -> {"runner", "ip", "service", "runner_info"}
+service_index = {}
+# Replication state: live replica ids and their URLs, when our leader lease
+# expires (wall clock), and the runner shards of the other replicas as
+# replica id -> (mtime, {ip: {"data", "debug", "digest"}}, confirmed gone ips),
+# and the ips their current owner confirmed gone
+replica_members = [REPLICA_ID]
+replica_urls = {}
+leader_until = 0
+shared_shards = {}
+shared_gone = set()
+published_shard_digest = None
+
+# Resource load fetched from each runner-info's /stats for /api/load,
+# refreshed in the background by refresh_runner_load()
+runner_load = {"fetched_at": 0, "refreshing": False, "runners": {}}
+runner_load_lock = threading.Lock()
+
+# Routers parsed by runner-info, split off the runner data for the host index:
+# ip -> {service name: {"routers": [...]}}, see index_debug()
+service_debug = {}
+# Full debug blocks fetched on demand: ip -> (fetched at, {service name: debug}),
+# least recently used first, and the ips with a fetch in flight
+debug_cache = OrderedDict()
+debug_fetching = set()
+debug_cache_lock = threading.Lock()
+
+# Host lookup index: lowercased host -> [match], plus HostRegexp rules as
+# (regex, match) lists keyed by the static domain suffix after their last
+# placeholder; host_index_runners holds each runner's share as
+# ip -> (runner_data, hosts, patterns) so only changed runners are re-indexed
+host_index = {}
+host_patterns = {}
+host_index_runners = {}
+# Access log host -> whether lookup_host() knows it, for the host_patterns it was computed with
+access_host_cache = OrderedDict()
+access_host_index = None
+# Last time each runner ip answered a poll (time.monotonic())
+runner_seen = {}
+# Runner ips with a stale-while-revalidate refresh in flight
+revalidating = set()
+revalidate_lock = threading.Lock()
+
+# What connected dashboards have been sent: ip -> slim runner, plus its version,
+# with the runner data each slim runner and its payload were built from
+dashboard_state = {}
+dashboard_version = 0
+dashboard_sources = {}
+dashboard_payloads = {}
+# (version, runner payloads) swapped in as a whole whenever dashboard_state
+# changes, so Socket.IO handlers can send a snapshot without taking state_lock
+dashboard_published = (0, [])
+
+# Runner ips that push deltas to /api/ingest, and when each ip was last polled
+push_capable = set()
+
+# Per-endpoint polling schedule and circuit breaker, keyed by ip
+poll_state = {}
+# Serializes changes to discovered_runners/endpoint_cache and config generation
+# between the refresh scheduler and /api/ingest
+state_lock = threading.RLock()
+
+# Content hash of each config shard last written to OUTPUT_DIR
+written_shards = {}
+
+# Routing table: (runner ip, service name) -> route, kept up to date per changed
+# runner by update_routes(), with indexes host -> route keys, shard file -> route
+# keys and ip -> route keys, the runner data each ip's routes were built from,
+# and the config last generated for each shard file
+routes = {}
+host_routes = {}
+shared_hosts = set()  # hosts with more than one route
+shard_routes = {}
+runner_route_keys = {}
+route_runners = {}
+shard_configs = {}
+# Journal of routing table changes; versions count up from 0 within routing_epoch
+routing_version = 0
+routing_epoch = uuid.uuid4().hex
+routing_journal = deque(maxlen=ROUTING_JOURNAL_SIZE)
+# (routing_version, journal, routes) as of the last change, replaced whole so
+# /api/routes can read it without taking state_lock
+routes_published = (0, (), [])
+
+# Last response seen per endpoint ip: {"etag", "digest", "data"}
+endpoint_cache = {}
+
+# Shared HTTP session so connections to runners are kept alive between cycles
+http_session = requests.Session()
+http_session.mount('http://', HTTPAdapter(pool_connections=DISCOVERY_WORKERS,
+                                          pool_maxsize=DISCOVERY_WORKERS,
+                                          max_retries=0))
+
+# Long-lived worker pool used by discover_runners()
+discovery_executor = ThreadPoolExecutor(max_workers=DISCOVERY_WORKERS,
+                                        thread_name_prefix='discovery')
+# Forwards pushed deltas to their owning replica one at a time, keeping their order
+forward_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='forward')
+# Accepted (ip, delta) pairs, applied in order by ingest_thread()
+ingest_queue = queue.Queue(INGEST_QUEUE_SIZE)
 
 app = Flask(__name__)
 socketio = SocketIO(app, cors_allowed_origins="*")
 
-# Load endpoints from file or use defaults
+def atomic_write(path, data):
+    """Write bytes to path via a temp file in the same directory and a rename"""
+    directory = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(path)}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+class EndpointStore:
+    """In-memory copy of ENDPOINTS_FILE indexed by id and ip.
+
+    Reads are served from memory; the file is only re-read when its mtime
+    changes (checked at most every ENDPOINTS_RECHECK_INTERVAL seconds).
+    Writes are serialized under a lock and an flock on a lock file beside it,
+    shared with the other replicas, re-read the file first and are persisted
+    atomically. The lists
+    and dicts handed out are never mutated in place, so callers may iterate
+    them without holding the lock.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.endpoints = []
+        self.by_id = {}
+        self.by_ip = {}
+        self.mtime = None
+        self.next_check = 0
+
+    def _index(self, endpoints):
+        self.endpoints = endpoints
+        self.by_id = {e['id']: e for e in endpoints}
+        self.by_ip = {e['ip']: e for e in endpoints}
+
+    @contextmanager
+    def _file_lock(self):
+        """Hold the lock and the flock on ENDPOINTS_FILE.lock, with the file freshly read"""
+        with self.lock:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(f"{self.path}.lock", 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    if not self._load():
+                        # Create file with defaults
+                        self._save(DEFAULT_ENDPOINTS)
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _load(self):
+        """Re-read the file if its mtime changed; False if it does not exist"""
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return False
+        if mtime == self.mtime:
+            return True
+        try:
+            with open(self.path, 'r') as f:
+                self._index(json.load(f))
+            self.mtime = mtime
+        except Exception as e:
+            log.error("Error loading endpoints: %s", e)
+            if self.mtime is None:
+                self._index(DEFAULT_ENDPOINTS)
+        return True
+
+    def _refresh(self):
+        now = time.monotonic()
+        if now < self.next_check:
+            return
+        with self.lock:
+            self.next_check = now + ENDPOINTS_RECHECK_INTERVAL
+            if not self._load():
+                with self._file_lock():
+                    pass  # creates it with the defaults
+
+    def _save(self, endpoints):
+        """Persist endpoints; only called under _file_lock()"""
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            atomic_write(self.path, json.dumps(endpoints, indent=2).encode())
+            self.mtime = os.stat(self.path).st_mtime_ns
+        except Exception as e:
+            log.error("Error saving endpoints: %s", e)
+        self._index(endpoints)
+
+    def all(self):
+        self._refresh()
+        return self.endpoints
+
+    def get(self, endpoint_id):
+        self._refresh()
+        return self.by_id.get(endpoint_id)
+
+    def get_by_ip(self, ip):
+        self._refresh()
+        return self.by_ip.get(ip)
+
+    def add(self, ip, description, capacity=1):
+        with self._file_lock():
+            endpoint = {"id": str(uuid.uuid4()), "ip": ip, "description": description, "capacity": capacity}
+            self._save(self.endpoints + [endpoint])
+            return endpoint
+
+    def update(self, endpoint_id, **fields):
+        with self._file_lock():
+            if endpoint_id not in self.by_id:
+                return None
+            endpoints = [dict(e, **fields) if e['id'] == endpoint_id else e
+                         for e in self.endpoints]
+            self._save(endpoints)
+            return self.by_id[endpoint_id]
+
+    def delete(self, endpoint_id):
+        with self._file_lock():
+            if endpoint_id not in self.by_id:
+                return False
+            self._save([e for e in self.endpoints if e['id'] != endpoint_id])
+            return True
+
+endpoint_store = EndpointStore(ENDPOINTS_FILE)
+
+class RefreshScheduler:
+    """Single-flight, debounced runner of discovery cycles.
+
+    Triggers arriving while a cycle is queued are coalesced into it; the
+    queued cycle starts once no trigger arrived for REFRESH_DEBOUNCE
+    seconds, but never later than REFRESH_MAX_DELAY after the first one.
+    Triggers arriving while a cycle runs queue exactly one follow-up cycle.
+    The periodic poll goes through the same worker, so cycles never overlap.
+    """
+
+    def __init__(self, run_cycle, interval, debounce, max_delay):
+        self.run_cycle = run_cycle
+        self.interval = interval
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.cond = threading.Condition()
+        self.cycles = OrderedDict()  # cycle id -> cycle record
+        self.next_id = 1
+        self.pending = None
+        self.pending_first = 0
+        self.pending_due = 0
+        self.next_periodic = time.monotonic()  # run the first cycle right away
+
+    def _new_cycle(self, reason):
+        cycle = {
+            "id": self.next_id,
+            "status": "queued",
+            "reasons": [reason],
+            "queued_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "started_at": None,
+            "finished_at": None,
+            "runner_count": None,
+            "error": None
+        }
+        self.next_id += 1
+        self.cycles[cycle["id"]] = cycle
+        while len(self.cycles) > REFRESH_HISTORY:
+            self.cycles.popitem(last=False)
+        return cycle
+
+    def trigger(self, reason):
+        """Request a cycle, returning a copy of the (possibly shared) queued cycle"""
+        with self.cond:
+            now = time.monotonic()
+            if self.pending is None:
+                self.pending = self._new_cycle(reason)
+                self.pending_first = now
+            elif reason not in self.pending["reasons"]:
+                self.pending["reasons"].append(reason)
+            self.pending_due = min(now + self.debounce, self.pending_first + self.max_delay)
+            self.cond.notify()
+            return dict(self.pending)
+
+    def get(self, cycle_id):
+        with self.cond:
+            cycle = self.cycles.get(cycle_id)
+            return dict(cycle) if cycle else None
+
+    def _next_cycle(self):
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                if self.pending is not None and now >= self.pending_due:
+                    cycle, self.pending = self.pending, None
+                    break
+                if self.pending is None and now >= self.next_periodic:
+                    cycle = self._new_cycle("periodic")
+                    break
+                wake_at = self.pending_due if self.pending is not None else self.next_periodic
+                self.cond.wait(wake_at - now)
+            cycle["status"] = "running"
+            cycle["started_at"] = time.strftime("%Y-%m-%d %H:%M:%S")
+            return cycle
+
+    def run(self):
+        """Worker loop, run in a dedicated thread"""
+        while True:
+            cycle = self._next_cycle()
+            try:
+                runner_count = self.run_cycle(cycle)
+                status, error = "done", None
+            except Exception as e:
+                log.error("Error in refresh cycle %s: %s", cycle['id'], e)
+                runner_count, status, error = None, "error", str(e)
+            with self.cond:
+                cycle.update(status=status, error=error, runner_count=runner_count,
+                             finished_at=time.strftime("%Y-%m-%d %H:%M:%S"))
+                self.next_periodic = time.monotonic() + self.interval
+
+refresh_scheduler = RefreshScheduler(lambda cycle: run_refresh_cycle(cycle),
+                                     POLL_TICK, REFRESH_DEBOUNCE, REFRESH_MAX_DELAY)
+
+class TrafficStats:
+    """Per-host request counts, status classes and latency percentiles over sliding windows.
+
+    Each host has a ring of fixed-width time buckets; a bucket holds a request
+    count, counts per status class and a sparse log-scale latency histogram
+    whose bins are ACCESS_LATENCY_GAMMA apart. Memory is bounded by hosts x
+    buckets x bins no matter how much traffic is ingested.
+    """
+    
+    def __init__(self, bucket_seconds, buckets, max_hosts, gamma):
+        self.bucket_seconds = bucket_seconds
+        self.buckets = buckets
+        self.max_hosts = max_hosts
+        self.log_gamma = math.log(gamma)
+        # Latencies are clamped to 0.01ms..10min, which bounds the bin count
+        self.min_bin = self.latency_bin(0.01)
+        self.max_bin = self.latency_bin(600000)
+        self.hosts = {}  # host -> ring of [bucket number, count, [1xx..5xx], {bin: count}] or None
+        self.lock = threading.Lock()
+        self.last_evict = 0
+    
+    def latency_bin(self, ms):
+        return math.ceil(math.log(ms) / self.log_gamma)
+    
+    def bin_value(self, index):
+        """Representative latency of a bin, within (gamma - 1) / 2 of every value in it"""
+        return 2 * math.exp(index * self.log_gamma) / (1 + math.exp(self.log_gamma))
+    
+    def record_many(self, requests, now):
+        """Add (host, status, duration_ms) tuples that arrived at time now"""
+        number = int(now // self.bucket_seconds)
+        position = number % self.buckets
+        with self.lock:
+            for host, status, ms in requests:
+                ring = self.hosts.get(host)
+                if ring is None:
+                    if len(self.hosts) >= self.max_hosts:
+                        host = OTHER_HOST
+                        ring = self.hosts.get(host)
+                    if ring is None:
+                        ring = self.hosts[host] = [None] * self.buckets
+                bucket = ring[position]
+                if bucket is None or bucket[0] != number:
+                    bucket = ring[position] = [number, 0, [0, 0, 0, 0, 0], {}]
+                bucket[1] += 1
+                if 100 <= status < 600:
+                    bucket[2][status // 100 - 1] += 1
+                index = self.latency_bin(ms) if ms > 0.01 else self.min_bin
+                index = min(index, self.max_bin)
+                bucket[3][index] = bucket[3].get(index, 0) + 1
+            
+            # Forget hosts without requests in the whole window once per bucket
+            if number != self.last_evict:
+                self.last_evict = number
+                oldest = number - self.buckets
+                for host in [h for h, ring in self.hosts.items()
+                             if all(b is None or b[0] <= oldest for b in ring)]:
+                    del self.hosts[host]
+    
+    def summary(self, host, seconds, now):
+        """Requests, rate, status classes and latency percentiles of host over the last seconds"""
+        number = int(now // self.bucket_seconds)
+        first = number - min(self.buckets, max(1, int(seconds // self.bucket_seconds))) + 1
+        count = 0
+        classes = [0, 0, 0, 0, 0]
+        bins = {}
+        with self.lock:
+            for bucket in self.hosts.get(host) or []:
+                if bucket is None or not first <= bucket[0] <= number:
+                    continue
+                count += bucket[1]
+                for i, value in enumerate(bucket[2]):
+                    classes[i] += value
+                for index, value in bucket[3].items():
+                    bins[index] = bins.get(index, 0) + value
+        
+        latency = {}
+        if count:
+            ranks = {"p50": 0.5, "p90": 0.9, "p99": 0.99}
+            seen = 0
+            pending = sorted(ranks.items(), key=lambda item: item[1])
+            for index in sorted(bins):
+                seen += bins[index]
+                while pending and seen >= pending[0][1] * count:
+                    latency[pending.pop(0)[0]] = round(self.bin_value(index), 2)
+        return {
+            "requests": count,
+            "rate": round(count / ((number - first + 1) * self.bucket_seconds), 3),
+            "status": {f"{i + 1}xx": value for i, value in enumerate(classes)},
+            "latency_ms": latency
+        }
+    
+    def tracked_hosts(self):
+        with self.lock:
+            return list(self.hosts)
+
+traffic_stats = TrafficStats(ACCESS_BUCKET_SECONDS, ACCESS_WINDOW_BUCKETS, ACCESS_MAX_HOSTS, ACCESS_LATENCY_GAMMA)
+
+# Load endpoints from the in-memory store
 def load_endpoints():
+    return endpoint_store.all()
+
+def endpoint_capacity(ip):
+    """Load balancing weight of a runner, from its endpoint's capacity"""
+    endpoint = endpoint_store.get_by_ip(ip) or {}
     try:
-        if os.path.exists(ENDPOINTS_FILE):
-            with open(ENDPOINTS_FILE, 'r') as f:
-                return json.load(f)
-        else:
-            # Create file with defaults
-            save_endpoints(DEFAULT_ENDPOINTS)
-            return DEFAULT_ENDPOINTS
-    except Exception as e:
-        print(f"Error loading endpoints: {e}")
-        return DEFAULT_ENDPOINTS
+        return max(1, int(endpoint.get('capacity', 1)))
+    except (TypeError, ValueError):
+        return 1
 
-# Save endpoints to file
-def save_endpoints(endpoints):
+def parse_capacity(value):
+    """Capacity submitted in the endpoints form, or None if invalid"""
     try:
-        os.makedirs(os.path.dirname(ENDPOINTS_FILE), exist_ok=True)
-        with open(ENDPOINTS_FILE, 'w') as f:
-            json.dump(endpoints, f, indent=2)
-    except Exception as e:
-        print(f"Error saving endpoints: {e}")
+        capacity = int(value or 1)
+    except ValueError:
+        return None
+    # A weight of 0 on every runner of a host would leave it without traffic
+    return capacity if capacity >= 1 else None
 
 @app.route('/')
 def index():
@@ -64,273 +622,1753 @@ def index():
     return render_template('index.html', 
                            runners=discovered_runners, 
                            last_updated=last_updated,
+                           stale=state_stale,
                            base_domain=DOMAIN_BASE,
                            endpoints=endpoints)
 
 @app.route('/endpoints')
 def endpoints_page():
     endpoints = load_endpoints()
-    return render_template('endpoints.html', endpoints=endpoints)
+    return render_template('endpoints.html',
+                           endpoints=endpoints,
+                           polling={e['ip']: poll_status(e['ip']) for e in endpoints})
 
 @app.route('/endpoints/add', methods=['POST'])
 def add_endpoint():
     ip = request.form.get('ip', '').strip()
     description = request.form.get('description', '').strip()
+    capacity = parse_capacity(request.form.get('capacity', '').strip())
     
     if not ip:
         return jsonify({"status": "error", "message": "IP address is required"}), 400
+    if capacity is None:
+        return jsonify({"status": "error", "message": "Capacity must be a positive integer"}), 400
     
-    endpoints = load_endpoints()
-    endpoints.append({
-        "id": str(uuid.uuid4()),
-        "ip": ip,
-        "description": description
-    })
-    
-    save_endpoints(endpoints)
-    socketio.emit('endpoints_updated')
+    endpoint_store.add(ip, description, capacity)
+    socketio.emit('endpoints_updated', {'endpoints': load_endpoints()})
     
-    # Trigger an immediate refresh of runner discovery
-    threading.Thread(target=lambda: refresh_config()).start()
+    # Trigger a refresh of runner discovery
+    refresh_scheduler.trigger('endpoint added')
     
     return redirect('/endpoints')
 
 @app.route('/endpoints/delete/<endpoint_id>', methods=['POST'])
 def delete_endpoint(endpoint_id):
-    endpoints = load_endpoints()
-    endpoints = [e for e in endpoints if e.get('id') != endpoint_id]
-    save_endpoints(endpoints)
-    socketio.emit('endpoints_updated')
+    endpoint_store.delete(endpoint_id)
+    socketio.emit('endpoints_updated', {'endpoints': load_endpoints()})
     
-    # Trigger an immediate refresh of runner discovery
-    threading.Thread(target=lambda: refresh_config()).start()
+    # Trigger a refresh of runner discovery
+    refresh_scheduler.trigger('endpoint deleted')
     
     return redirect('/endpoints')
 
 @app.route('/endpoints/edit/<endpoint_id>', methods=['POST'])
 def edit_endpoint(endpoint_id):
+    global config_dirty
     ip = request.form.get('ip', '').strip()
     description = request.form.get('description', '').strip()
+    capacity = parse_capacity(request.form.get('capacity', '').strip())
     
     if not ip:
         return jsonify({"status": "error", "message": "IP address is required"}), 400
+    if capacity is None:
+        return jsonify({"status": "error", "message": "Capacity must be a positive integer"}), 400
     
-    endpoints = load_endpoints()
-    for endpoint in endpoints:
-        if endpoint.get('id') == endpoint_id:
-            endpoint['ip'] = ip
-            endpoint['description'] = description
-            break
+    endpoint_store.update(endpoint_id, ip=ip, description=description, capacity=capacity)
+    socketio.emit('endpoints_updated', {'endpoints': load_endpoints()})
     
-    save_endpoints(endpoints)
-    socketio.emit('endpoints_updated')
+    # A capacity change alters the load balancer weights without any runner changing
+    config_dirty = True
     
-    # Trigger an immediate refresh of runner discovery
-    threading.Thread(target=lambda: refresh_config()).start()
+    # Trigger a refresh of runner discovery
+    refresh_scheduler.trigger('endpoint edited')
     
     return redirect('/endpoints')
 
 @app.route('/api/runners')
 def api_runners():
+    """Discovered runners in their compact form.
+
+    ?fields=ip,runner,... selects runner fields and ?offset=&limit= pages
+    through the runners; debug data is served by /api/runners/<ip>/debug.
+    """
+    fields = [field.strip() for field in request.args.get('fields', '').split(',') if field.strip()]
+    try:
+        offset = max(0, int(request.args.get('offset', 0)))
+        limit = int(request.args['limit']) if request.args.get('limit') else None
+    except ValueError:
+        return jsonify({"status": "error", "message": "offset and limit must be integers"}), 400
+    
+    runners = discovered_runners
+    page = runners[offset:offset + limit] if limit is not None else runners[offset:]
+    if fields:
+        page = [{field: runner[field] for field in fields if field in runner} for runner in page]
+    
+    endpoints = load_endpoints()
     return jsonify({
-        "runners": discovered_runners,
+        "runners": page,
+        "total": len(runners),
+        "offset": offset,
+        "limit": limit,
         "last_updated": last_updated,
-        "endpoints": [e['ip'] for e in load_endpoints()]
+        "endpoints": [e['ip'] for e in endpoints],
+        "stale": state_stale,
+        "polling": {e['ip']: poll_status(e['ip']) for e in endpoints}
+    })
+
+@app.route('/api/runners/<ip>/debug')
+def api_runner_debug(ip):
+    """Debug blocks (Traefik labels, networks) of a runner's services.
+
+    Answers 202 while they are fetched from the runner in the background.
+    """
+    if ip not in endpoint_cache:
+        return jsonify({"status": "error", "message": f"Unknown runner {ip}"}), 404
+    debug = cached_debug(ip)
+    if debug is None:
+        return jsonify({"status": "pending"}), 202
+    return jsonify(debug)
+
+@app.route('/api/traffic')
+def api_traffic():
+    """Traffic per host from the access log: ?host= for one host, ?window= one of ACCESS_WINDOWS"""
+    window = request.args.get('window', '5m')
+    if window not in ACCESS_WINDOWS:
+        return jsonify({"status": "error", "message": f"window must be one of {', '.join(ACCESS_WINDOWS)}"}), 400
+    
+    now = time.time()
+    host = request.args.get('host', '').strip().lower()
+    hosts = [host] if host else traffic_stats.tracked_hosts()
+    traffic = {h: traffic_stats.summary(h, ACCESS_WINDOWS[window], now) for h in hosts}
+    return jsonify({
+        "window": window,
+        "enabled": bool(ACCESS_LOG_FILE),
+        "hosts": dict(sorted(traffic.items(), key=lambda item: -item[1]['requests']))
+    })
+
+@app.route('/api/load')
+def api_load():
+    """Resource load per runner and service, aggregated from every runner-info's /stats.
+
+    Always answers from the cache; once it is older than LOAD_CACHE_SECONDS
+    a refresh is started in the background for the next request.
+    """
+    with runner_load_lock:
+        # Single-flight: only one refresh runs at a time
+        start = not runner_load['refreshing'] and time.monotonic() - runner_load['fetched_at'] > LOAD_CACHE_SECONDS
+        if start:
+            runner_load['refreshing'] = True
+        runners = runner_load['runners']
+    if start:
+        threading.Thread(target=refresh_runner_load, daemon=True).start()
+    
+    total = {}
+    for runner in runners.values():
+        for field, value in (runner.get('load') or {}).items():
+            total[field] = round(total.get(field, 0) + value, 2)
+    return jsonify({"runners": runners, "total": total})
+
+@app.route('/api/routes')
+def api_routes():
+    """The routing table, or with ?since=<version> the changes made after that version.
+
+    Changes come from the journal of the process named by ?epoch=; if the
+    epoch differs or the version is older than the journal, the full table
+    is returned with "reset": true instead. Served from routes_published
+    without taking state_lock.
+    """
+    since = request.args.get('since', type=int)
+    epoch = request.args.get('epoch', routing_epoch)
+    version, journal, table = routes_published
+    body = {"epoch": routing_epoch, "version": version, "leader": is_leader()}
+    oldest = journal[0]['version'] if journal else version + 1
+    if since is not None and epoch == routing_epoch and oldest - 1 <= since <= version:
+        body["changes"] = [change for change in journal if change['version'] > since]
+    else:
+        body["reset"] = since is not None
+        body["routes"] = table
+    return jsonify(body)
+
+@app.route('/api/replicas')
+def api_replicas():
+    """Live replicas, which one this is, whether it leads and the endpoints it polls"""
+    endpoints = load_endpoints()
+    return jsonify({
+        "replication": REPLICATION,
+        "id": REPLICA_ID,
+        "leader": is_leader(),
+        "members": {member: replica_urls.get(member) for member in replica_members},
+        "owned": [e['ip'] for e in endpoints if owner_of(e['ip']) == REPLICA_ID]
     })
 
 @app.route('/api/endpoints')
 def api_endpoints():
     return jsonify(load_endpoints())
 
+@app.route('/api/lookup')
+def api_lookup():
+    """Which runners serve a Host, answered from the host index"""
+    host = request.args.get('host', '').strip()
+    if not host:
+        return jsonify({"status": "error", "message": "host parameter is required"}), 400
+    
+    matches = lookup_host(host)
+    return jsonify({
+        "host": host,
+        "matches": matches,
+        "stale": state_stale
+    }), 200 if matches else 404
+
 @app.route('/api/refresh', methods=['GET', 'POST'])
 def refresh_config():
-    """Webhook endpoint to trigger immediate refresh"""
-    print("Refresh webhook triggered")
-    
-    # Run discovery and generate config synchronously
-    runners = discover_runners()
-    generate_config(runners)
-    
-    # Notify all connected clients of the update
-    socketio.emit('config_updated', {
-        'timestamp': time.strftime("%Y-%m-%d %H:%M:%S"),
-        'runner_count': len(runners)
-    })
+    """Webhook endpoint to trigger an immediate refresh"""
+    cycle = refresh_scheduler.trigger('webhook')
+    log.info("Refresh webhook triggered, cycle %s queued", cycle['id'])
     
     return jsonify({
-        "status": "success",
-        "message": "Configuration refresh triggered",
+        "status": "accepted",
+        "message": "Configuration refresh scheduled",
         "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
-        "services_count": len(runners)
-    })
+        "cycle_id": cycle['id'],
+        "cycle_url": url_for('refresh_status', cycle_id=cycle['id'])
+    }), 202
 
-@app.route('/service/<path:service_path>')
-def service_detail(service_path):
-    """Display detailed information about a specific service"""
-    # Parse runner and service name from the path
-    if '-' in service_path:
-        # Format: runner-service
-        parts = service_path.split('-', 1)  # Split only on first hyphen
-        runner = parts[0]
-        service_name = parts[1]
-    else:
-        # Format: just service name (default runner)
-        runner = 'default'
-        service_name = service_path
+@app.route('/api/refresh/<int:cycle_id>')
+def refresh_status(cycle_id):
+    """Status of a refresh cycle returned by /api/refresh"""
+    cycle = refresh_scheduler.get(cycle_id)
+    if cycle is None:
+        return jsonify({"status": "error", "message": "Unknown cycle"}), 404
+    return jsonify(cycle)
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus metrics"""
+    return Response(generate_latest(), mimetype=CONTENT_TYPE_LATEST)
+
+@app.route('/api/ingest', methods=['POST'])
+def ingest_delta():
+    """Accept a service delta pushed by a runner's runner-info.
+
+    The delta carries added/changed service records, removed service names
+    and a sequence number that must follow the version the registry last
+    saw from that runner. It is only validated here and applied by
+    ingest_thread(); on a sequence gap the runner is resynced with a full poll.
+    """
+    delta = request.get_json(silent=True)
+    error = delta_error(delta)
+    if error:
+        return jsonify({"status": "error", "message": f"Invalid delta: {error}"}), 400
     
-    # Find the runner in our list
-    runner_data = None
-    for r in discovered_runners:
-        # Match default runner with empty runner name
-        if (runner == 'default' and (not r.get('runner') or r.get('runner') == '')) or r.get('runner') == runner:
-            runner_data = r
-            break
+    ip = delta.get('ip') or request.headers.get('X-Forwarded-For', request.remote_addr).split(',')[0].strip()
+    if endpoint_store.get_by_ip(ip) is None:
+        return jsonify({"status": "error", "message": f"Unknown endpoint {ip}"}), 404
+    if owner_of(ip) != REPLICA_ID and not request.headers.get('X-Registry-Forwarded'):
+        return forward_delta(ip, delta)
     
-    if not runner_data:
-        abort(404)
-        
-    # Get the runner domain
-    if runner == "default":
-        full_domain = DOMAIN_BASE
-    else:
-        full_domain = f"{runner}.{DOMAIN_BASE}"
-    
-    # Fetch service details from the runner's info API
     try:
-        runner_info_url = f"http://{full_domain}/runner-info/json"
-        print(f"Fetching service details from: {runner_info_url}")
-        response = requests.get(runner_info_url, timeout=5)
-        if response.status_code == 200:
-            runner_info = response.json()
+        ingest_queue.put_nowait((ip, delta))
+    except queue.Full:
+        # Dropping it leaves a sequence gap, so the runner is resynced later
+        return jsonify({"status": "error", "message": "Too many pending deltas"}), 503
+    return jsonify({"status": "accepted"}), 202
+
+def delta_error(delta):
+    """What is wrong with a pushed delta, or None if it can be applied"""
+    if not isinstance(delta, dict):
+        return "not a JSON object"
+    if not isinstance(delta.get('seq'), int) or isinstance(delta['seq'], bool):
+        return "seq must be an integer"
+    for field in ('ip', 'epoch', 'etag'):
+        if delta.get(field) is not None and not isinstance(delta[field], str):
+            return f"{field} must be a string"
+    for field in ('added', 'changed'):
+        services = delta.get(field, [])
+        if not isinstance(services, list) or not all(
+                isinstance(service, dict) and isinstance(service.get('name'), str) for service in services):
+            return f"{field} must be a list of services with a name"
+    removed = delta.get('removed', [])
+    if not isinstance(removed, list) or not all(isinstance(name, str) for name in removed):
+        return "removed must be a list of service names"
+    return None
+
+def ingest_thread():
+    """Apply accepted deltas in order, publishing each burst of them at once"""
+    while True:
+        batch = [ingest_queue.get()]
+        while True:
+            try:
+                batch.append(ingest_queue.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            apply_deltas(batch)
+        except Exception as e:
+            log.error("Error applying %d deltas: %s", len(batch), e)
+
+def apply_deltas(batch):
+    """Apply (ip, delta) pairs to endpoint_cache and publish the runners that changed"""
+    changed = {}
+    with state_lock:
+        for ip, delta in batch:
+            cached = endpoint_cache.get(ip)
+            base = cached['data'] if cached else None
             
-            # Find the requested service
-            service_info = None
-            for service in runner_info.get('services', []):
-                if service['name'] == service_name:
-                    service_info = service
-                    break
+            if base and base.get('epoch') == delta.get('epoch') and base.get('version') is not None:
+                if delta['seq'] <= base['version']:
+                    # Already seen, e.g. the poll picked it up first
+                    continue
+                in_sequence = delta['seq'] == base['version'] + 1
+            else:
+                in_sequence = False
+            
+            if not in_sequence:
+                # Sequence gap or unknown base: poll the runner's full /json next cycle
+                log.warning("Sequence gap from %s (seq %d), scheduling full resync", ip, delta['seq'])
+                push_capable.discard(ip)
+                poll_state.get(ip, {})['next_poll'] = 0
+                refresh_scheduler.trigger(f'resync {ip}')
+                continue
             
-            if service_info:
-                print(f"Found service info: {service_info}")
-                return render_template('service_detail.html',
-                                      runner=runner,
-                                      service=service_info,
-                                      runner_info=runner_info)
+            runner_data = apply_delta(base, delta)
+            endpoint_cache[ip] = {
+                "etag": f'"{delta["etag"]}"' if delta.get('etag') else None,
+                "digest": None,
+                "data": runner_data
+            }
+            push_capable.add(ip)
+            runner_seen[ip] = time.monotonic()
+            record_poll(ip, True, True)
+            changed[ip] = runner_data
+            log.info("Applied delta seq %d from %s: +%d ~%d -%d", delta['seq'], ip,
+                     len(delta.get('added', [])), len(delta.get('changed', [])), len(delta.get('removed', [])))
+        
+        if changed:
+            publish_runners(list(changed.values()))
+            broadcast_runner_changes(discovered_runners)
+
+def apply_delta(base, delta):
+    """Return a new runner data dict with a delta applied to base"""
+    services = {service['name']: service for service in base.get('services') or []}
+    for name in delta.get('removed', []):
+        services.pop(name, None)
+    for service in delta.get('added', []) + delta.get('changed', []):
+        services[service['name']] = service
+    
+    runner_data = dict(base)
+    runner_data['services'] = sorted(services.values(), key=lambda x: x['name'])
+    runner_data['version'] = delta['seq']
+    runner_data['last_updated'] = delta.get('last_updated', base.get('last_updated'))
+    return compact_runner(runner_data, base['ip'])
+
+def fetch_runner_load(runner_data):
+    """Current resource load of one runner from its runner-info /stats"""
+    url = f"http://{runner_data['ip']}/runner-info/stats?history=0"
+    result = {"runner": runner_data.get('runner') or 'default'}
+    try:
+        response = http_session.get(url, timeout=(ENDPOINT_CONNECT_TIMEOUT, ENDPOINT_READ_TIMEOUT))
+        response.raise_for_status()
+        stats = response.json()
+        result.update(load=stats.get('load'), services=stats.get('services', {}))
+    except Exception as e:
+        result['error'] = str(e)
+    return result
+
+def refresh_runner_load():
+    """Fetch the load of every runner in parallel and replace the /api/load cache"""
+    try:
+        futures = {r['ip']: discovery_executor.submit(fetch_runner_load, r) for r in discovered_runners}
+        runners = {ip: future.result() for ip, future in futures.items()}
+    except Exception as e:
+        log.error("Error refreshing runner load: %s", e)
+        runners = None
+    with runner_load_lock:
+        if runners is not None:
+            runner_load['runners'] = runners
+        runner_load['fetched_at'] = time.monotonic()
+        runner_load['refreshing'] = False
+
+def cached_debug(ip):
+    """A runner's full debug blocks from debug_cache, or None while they are fetched.
+
+    Missing or expired entries are fetched in the background (single-flight
+    per ip), so request handlers never wait on the runner.
+    """
+    with debug_cache_lock:
+        cached = debug_cache.get(ip)
+        if cached is not None:
+            debug_cache.move_to_end(ip)
+        if cached is not None and time.monotonic() - cached[0] <= DEBUG_CACHE_SECONDS:
+            return cached[1]
+        if ip in debug_fetching:
+            return cached[1] if cached else None
+        debug_fetching.add(ip)
+    discovery_executor.submit(fetch_debug, ip)
+    return cached[1] if cached else None
+
+def fetch_debug(ip):
+    """Fetch the debug blocks of a runner's services from its runner-info into debug_cache"""
+    url = f"http://{ip}/runner-info/json"
+    debug = None
+    try:
+        response = http_session.get(url, timeout=(ENDPOINT_CONNECT_TIMEOUT, ENDPOINT_READ_TIMEOUT))
+        response.raise_for_status()
+        debug = {service['name']: service.get('debug') or {} for service in response.json().get('services') or []}
+    except Exception as e:
+        log.warning("Error fetching debug blocks from %s: %s", url, e)
+    with debug_cache_lock:
+        debug_fetching.discard(ip)
+        if debug is not None:
+            debug_cache[ip] = (time.monotonic(), debug)
+            debug_cache.move_to_end(ip)
+            while len(debug_cache) > DEBUG_CACHE_SIZE:
+                debug_cache.popitem(last=False)
+
+def index_debug(debug):
+    """The part of a service's debug block kept in memory: the router, rule and
+    host matchers of each router, which is all runner_host_entries() reads"""
+    labels = debug.get('labels') or {}
+    routers = []
+    for router in debug.get('routers') or []:
+        compact = {"router": router['router'],
+                   "rule": labels.get(f"traefik.http.routers.{router['router']}.rule", router.get('rule'))}
+        for field in ('hosts', 'hostRegexps'):
+            if router.get(field):
+                compact[field] = router[field]
+        routers.append(compact)
+    return {"routers": routers}
+
+def intern_str(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+def compact_runner(runner_data, ip):
+    """Normalize a runner-info document into the compact form kept in memory.
+
+    Only the fields the registry uses are kept, strings repeated across
+    runners and services are interned, and the routers of each service's
+    debug block move to service_debug (services without one keep their
+    previous routers). Labels and networks are dropped, see cached_debug().
+    """
+    previous_debug = service_debug.get(ip, {})
+    debug = {}
+    services = []
+    for service in runner_data.get('services') or []:
+        name = service['name']
+        if service.get('debug') is not None:
+            debug[name] = index_debug(service['debug'])
+        elif name in previous_debug:
+            debug[name] = previous_debug[name]
+        compact = {
+            "name": name,
+            "container": service.get('container'),
+            "fullDomain": service.get('fullDomain'),
+            "status": intern_str(service.get('status'))
+        }
+        # Only services routed for more hosts than fullDomain carry the list
+        if len(service.get('hosts') or []) > 1:
+            compact["hosts"] = service['hosts']
+        services.append(compact)
+    service_debug[ip] = debug
+    
+    return {
+        "ip": intern_str(ip),
+        "runner": intern_str(runner_data.get('runner')),
+        "domain": intern_str(runner_data.get('domain')),
+        "version": runner_data.get('version'),
+        "epoch": intern_str(runner_data.get('epoch')),
+        "last_updated": runner_data.get('last_updated'),
+        "services": services
+    }
+
+def publish_runners(updated):
+    """Swap runners' data into the live state and regenerate their config.
+
+    Must be called with state_lock held.
+    """
+    global discovered_runners, last_updated
+    order = {endpoint['ip']: i for i, endpoint in enumerate(load_endpoints())}
+    updated_ips = {runner_data['ip'] for runner_data in updated}
+    runners = [r for r in discovered_runners if r['ip'] not in updated_ips]
+    runners.extend(updated)
+    runners.sort(key=lambda r: order.get(r['ip'], len(order)))
+    
+    discovered_runners = runners
+    last_updated = time.strftime("%Y-%m-%d %H:%M:%S")
+    for runner_data in updated:
+        update_service_index(runner_data)
+    if is_leader():
+        write_config(runners, full=False)
+    else:
+        update_routes(runners)
+    if REPLICATION:
+        publish_shard(runners)
+
+@app.route('/service/<path:service_path>')
+def service_detail(service_path):
+    """Display detailed information about a specific service"""
+    entry = service_index.get(service_path)
+    
+    if entry is None:
+        # Parse runner and service name from the path
+        if '-' in service_path:
+            # Format: runner-service
+            runner, service_name = service_path.split('-', 1)  # Split only on first hyphen
+        else:
+            # Format: just service name (default runner)
+            runner = 'default'
+            service_name = service_path
         
-        # If we couldn't find the service or runner-info failed
-        print(f"Could not find service {service_name} in runner {runner}")
+        # Match default runner with empty runner name
+        if not any((r.get('runner') or 'default') == runner for r in discovered_runners):
+            abort(404)
+        
+        log.info("Could not find service %s in runner %s", service_name, runner)
         return render_template('service_detail.html',
                               runner=runner,
                               service={'name': service_name, 'error': 'Service not found'},
                               runner_info={'error': 'Could not fetch detailed service information'})
-                               
+    
+    # Serve the indexed record right away, refreshing it in the background if stale
+    if time.monotonic() - runner_seen.get(entry['ip'], 0) > SERVICE_DETAIL_MAX_AGE:
+        revalidate_runner(entry['ip'])
+    
+    debug = cached_debug(entry['ip'])
+    now = time.time()
+    host = (entry['service'].get('fullDomain') or '').lower()
+    traffic = {window: traffic_stats.summary(host, seconds, now) for window, seconds in ACCESS_WINDOWS.items()}
+    return render_template('service_detail.html',
+                          runner=entry['runner'],
+                          service=dict(entry['service'], debug=(debug or {}).get(entry['service']['name'])),
+                          debug_pending=debug is None,
+                          runner_info=entry['runner_info'],
+                          traffic=traffic if ACCESS_LOG_FILE else None)
+
+def service_path_for(runner_name, service_name):
+    """URL path of a service detail page, matching the dashboard links"""
+    return f"{runner_name}-{service_name}" if runner_name else service_name
+
+def index_runner(index, runner_data):
+    """Add every service of a runner to a service index dict"""
+    runner_name = runner_data.get('runner') or ''
+    for service in runner_data.get('services') or []:
+        index[service_path_for(runner_name, service['name'])] = {
+            "runner": runner_name or 'default',
+            "ip": runner_data['ip'],
+            "service": service,
+            "runner_info": runner_data
+        }
+
+def build_service_index(runners):
+    """Rebuild the service index from a full discovery result"""
+    global service_index
+    index = {}
+    for runner_data in runners:
+        index_runner(index, runner_data)
+    service_index = index
+    
+    # Only runners whose data changed are re-indexed in the host index
+    current = {runner_data['ip']: runner_data for runner_data in runners}
+    changes = {ip: None for ip in host_index_runners if ip not in current}
+    for ip, runner_data in current.items():
+        indexed = host_index_runners.get(ip)
+        if indexed is None or indexed[0] is not runner_data:
+            changes[ip] = runner_data
+    if changes:
+        reindex_hosts(changes)
+
+def update_service_index(runner_data):
+    """Replace a single runner's services in the service index"""
+    global service_index
+    index = {path: entry for path, entry in service_index.items()
+             if entry['ip'] != runner_data['ip']}
+    index_runner(index, runner_data)
+    service_index = index
+    reindex_hosts({runner_data['ip']: runner_data})
+
+def host_regexp(template):
+    """Compile a Traefik v2 HostRegexp template like `{number:[0-9]+}-app.example.com`.
+
+    Returns (suffix, regex): the static domain after the last placeholder,
+    used as the index key, and a case-insensitive regex for the whole host.
+    """
+    parts = []
+    position = 0
+    for placeholder in re.finditer(r'\{\w+(?::((?:[^{}]|\{[^{}]*\})+))?\}', template):
+        parts.append(re.escape(template[position:placeholder.start()]))
+        parts.append(f"(?:{placeholder.group(1)})" if placeholder.group(1) else r'[^.]+')
+        position = placeholder.end()
+    literal = template[position:]
+    parts.append(re.escape(literal))
+    suffix = literal.partition('.')[2] if position else literal
+    return suffix.lower(), re.compile(''.join(parts), re.IGNORECASE)
+
+def service_hosts(service):
+    """All hosts a service is routed for, fullDomain first"""
+    return service.get('hosts') or ([service['fullDomain']] if service.get('fullDomain') else [])
+
+def runner_host_entries(runner_data):
+    """Index one runner's services by host.
+
+    Returns (hosts, patterns) shaped like host_index and host_patterns.
+    Besides the service's hosts, the Host and HostRegexp matchers of the
+    routers runner-info parsed from its Traefik labels (debug.routers) are
+    indexed when the runner reports them.
+    """
+    hosts = {}
+    patterns = {}
+    runner_name = runner_data.get('runner') or 'default'
+    for service in runner_data.get('services') or []:
+        entry = {
+            "runner": runner_name,
+            "ip": runner_data['ip'],
+            "service": service['name'],
+            "container": service.get('container'),
+            "status": service.get('status'),
+            "fullDomain": service.get('fullDomain')
+        }
+        for host in service_hosts(service):
+            hosts.setdefault(host.lower(), []).append(entry)
+        
+        debug = service_debug.get(runner_data['ip'], {}).get(service['name']) or {}
+        for router in debug.get('routers') or []:
+            rule = router.get('rule')
+            for value in router.get('hosts') or []:
+                if value.lower() not in hosts:
+                    hosts[value.lower()] = [dict(entry, rule=rule)]
+            for value in router.get('hostRegexps') or []:
+                if '{' not in value:
+                    if value.lower() not in hosts:
+                        hosts[value.lower()] = [dict(entry, rule=rule)]
+                    continue
+                suffix, regex = host_regexp(value)
+                patterns.setdefault(suffix, []).append((regex, dict(entry, rule=rule)))
+    return hosts, patterns
+
+def reindex_hosts(changes):
+    """Apply {ip: runner_data or None} to the host lookup index.
+
+    The index dicts are copied and swapped so lookups never see a partial
+    update; runners not in changes keep their existing entries.
+    """
+    global host_index, host_patterns, host_index_runners
+    with state_lock:
+        hosts = dict(host_index)
+        patterns = dict(host_patterns)
+        runners = dict(host_index_runners)
+        for ip, runner_data in changes.items():
+            old = runners.pop(ip, None)
+            if old is not None:
+                for index, keys in ((hosts, old[1]), (patterns, old[2])):
+                    for key in keys:
+                        remaining = [item for item in index[key]
+                                     if (item[1] if isinstance(item, tuple) else item)['ip'] != ip]
+                        if remaining:
+                            index[key] = remaining
+                        else:
+                            del index[key]
+            if runner_data is None:
+                continue
+            own_hosts, own_patterns = runner_host_entries(runner_data)
+            for host, entries in own_hosts.items():
+                hosts[host] = hosts.get(host, []) + entries
+            for suffix, entries in own_patterns.items():
+                patterns[suffix] = patterns.get(suffix, []) + entries
+            runners[ip] = (runner_data, own_hosts, own_patterns)
+        host_index, host_patterns, host_index_runners = hosts, patterns, runners
+
+def lookup_host(host):
+    """Runners serving host: exact matches first, then matching HostRegexp rules.
+
+    One dict lookup for the host and one per domain suffix, so the cost
+    does not grow with the number of services.
+    """
+    host = host.lower().rstrip('.')
+    if host.count(':') == 1:
+        host = host.split(':')[0]  # drop a port
+    matches = [dict(entry, match="host") for entry in host_index.get(host, [])]
+    labels = host.split('.')
+    for i in range(len(labels) + 1):
+        for regex, entry in host_patterns.get('.'.join(labels[i:]), []):
+            if regex.fullmatch(host):
+                matches.append(dict(entry, match="pattern"))
+    return matches
+
+def revalidate_runner(ip):
+    """Refresh one runner's indexed services in the background (single-flight per ip)"""
+    endpoint = endpoint_store.get_by_ip(ip)
+    if endpoint is None:
+        return
+    with revalidate_lock:
+        if ip in revalidating:
+            return
+        revalidating.add(ip)
+    
+    def refresh():
+        try:
+            # Leave endpoint_cache alone so the next discovery cycle still
+            # notices the change and regenerates the Traefik config
+            runner_data, changed = fetch_runner(endpoint, update_cache=False)
+            if runner_data is not None:
+                runner_seen[ip] = time.monotonic()
+                if changed:
+                    update_service_index(runner_data)
+        finally:
+            with revalidate_lock:
+                revalidating.discard(ip)
+    
+    discovery_executor.submit(refresh)
+
+def fetch_runner(endpoint, update_cache=True):
+    """Poll a single runner endpoint, recording latency and errors"""
+    started = time.monotonic()
+    runner_data, changed = poll_runner(endpoint, update_cache)
+    ENDPOINT_FETCH_SECONDS.labels(endpoint['ip']).observe(time.monotonic() - started)
+    if runner_data is None:
+        ENDPOINT_FETCH_ERRORS.labels(endpoint['ip']).inc()
+    return runner_data, changed
+
+def poll_runner(endpoint, update_cache=True):
+    """Poll a single runner endpoint.
+
+    Returns a (runner_data, changed) tuple; runner_data is None on failure.
+    Unchanged runners are answered from endpoint_cache without parsing.
+    """
+    ip = endpoint['ip']
+    endpoint_url = f"http://{ip}/runner-info/json"
+    deadline = time.monotonic() + ENDPOINT_CONNECT_TIMEOUT + ENDPOINT_READ_TIMEOUT
+    cached = endpoint_cache.get(ip)
+    headers = {}
+    if cached and cached['etag']:
+        headers['If-None-Match'] = cached['etag']
+    try:
+        response = http_session.get(endpoint_url,
+                                    headers=headers,
+                                    timeout=(ENDPOINT_CONNECT_TIMEOUT, ENDPOINT_READ_TIMEOUT),
+                                    stream=True)
+        try:
+            if response.status_code == 304 and cached:
+                return cached['data'], False
+
+            if response.status_code != 200:
+                log.warning("Error polling %s: HTTP %d", endpoint_url, response.status_code)
+                return None, False
+
+            # The read timeout only bounds each socket read, so enforce an
+            # overall per-endpoint deadline while consuming the body
+            chunks = []
+            for chunk in response.iter_content(chunk_size=65536):
+                chunks.append(chunk)
+                if time.monotonic() > deadline:
+                    log.warning("Error polling %s: deadline exceeded", endpoint_url)
+                    return None, False
+            body = b''.join(chunks)
+            etag = response.headers.get('ETag')
+        finally:
+            response.close()
+
+        # Runners without ETag support still get change detection by content hash
+        digest = hashlib.sha1(body).hexdigest()
+        if cached and cached['digest'] == digest:
+            if update_cache:
+                cached['etag'] = etag
+            return cached['data'], False
+
+        try:
+            runner_data = json.loads(body)
+        except ValueError as e:
+            log.warning("Error parsing JSON from %s: %s", endpoint_url, e)
+            return None, False
+
+        # A pushed delta may already be newer than this response
+        if cached and cached['data'].get('epoch') == runner_data.get('epoch') \
+                and (cached['data'].get('version') or 0) > (runner_data.get('version') or 0):
+            return cached['data'], False
+        
+        # Keep the compact form, with the IP added
+        runner_data = compact_runner(runner_data, ip)
+        
+        if update_cache:
+            endpoint_cache[ip] = {"etag": etag, "digest": digest, "data": runner_data}
+        return runner_data, True
     except Exception as e:
-        print(f"Error in service_detail: {e}")
-        return render_template('service_detail.html',
-                              runner=runner,
-                              service={'name': service_name, 'error': str(e)},
-                              runner_info={'error': 'Error fetching runner information'})
+        log.warning("Error connecting to %s: %s", endpoint_url, e)
+        return None, False
 
-def discover_runners():
-    global discovered_runners, last_updated
-    runners = []
+def new_poll_state(now):
+    return {
+        "circuit": "closed",
+        "ok": False,
+        "failures": 0,
+        "interval": 0,
+        "next_poll": 0,
+        "last_poll": None,
+        "last_change": now
+    }
+
+def record_poll(ip, ok, changed):
+    """Update an endpoint's circuit and schedule its next poll after a result.
+
+    Failing endpoints back off exponentially, and their circuit opens after
+    CIRCUIT_FAILURE_THRESHOLD failures in a row; the next poll is then a
+    single half-open probe. Healthy endpoints are polled fast right after a
+    change and slowly once stable. Every interval is jittered.
+    """
+    now = time.monotonic()
+    state = poll_state.setdefault(ip, new_poll_state(now))
+    state['last_poll'] = now
     
-    endpoints = load_endpoints()
+    if ok:
+        state.update(ok=True, failures=0, circuit='closed')
+        if changed:
+            state['last_change'] = now
+        if ip in push_capable:
+            interval = PUSH_POLL_INTERVAL
+        elif now - state['last_change'] < RECENT_CHANGE_WINDOW:
+            interval = FAST_POLL_INTERVAL
+        elif now - state['last_change'] > STABLE_AFTER:
+            interval = SLOW_POLL_INTERVAL
+        else:
+            interval = POLLING_INTERVAL
+    else:
+        state['ok'] = False
+        state['failures'] += 1
+        if state['failures'] >= CIRCUIT_FAILURE_THRESHOLD:
+            state['circuit'] = 'open'
+        interval = min(POLLING_INTERVAL * 2 ** (state['failures'] - 1), MAX_BACKOFF)
     
-    for endpoint in endpoints:
+    interval *= random.uniform(1 - POLL_JITTER, 1 + POLL_JITTER)
+    state['interval'] = interval
+    state['next_poll'] = now + interval
+
+def poll_status(ip):
+    """Circuit state and schedule of an endpoint, for the API and endpoints page"""
+    state = poll_state.get(ip)
+    owner = owner_of(ip)
+    if state is None or owner != REPLICA_ID:
+        return {"circuit": "closed", "failures": 0, "next_poll_in": 0, "interval": None, "push": False, "owner": owner}
+    now = time.monotonic()
+    return {
+        "owner": owner,
+        "circuit": state['circuit'],
+        "failures": state['failures'],
+        "next_poll_in": max(0, round(state['next_poll'] - now, 1)),
+        "interval": round(state['interval'], 1),
+        "last_poll_ago": round(now - state['last_poll'], 1) if state['last_poll'] else None,
+        "last_change_ago": round(now - state['last_change'], 1),
+        "push": ip in push_capable
+    }
+
+def discover_runners(force=False):
+    """Poll the endpoints that are due concurrently, publishing results as they arrive.
+
+    With force every endpoint is polled regardless of its schedule or circuit.
+    """
+    global discovered_runners, last_updated, discovery_changed, last_cycle_full, confirmed_gone
+
+    endpoints = load_endpoints()
+    order = {endpoint['ip']: i for i, endpoint in enumerate(endpoints)}
+    started = time.monotonic()
+    previous_ips = [r['ip'] for r in discovered_runners]
+
+    # Seed the partial view with the previous cycle's data so the dashboard
+    # keeps showing runners that have not answered yet
+    partial = {r['ip']: r for r in discovered_runners if r.get('ip') in order}
+    fresh = {}
+    changed = False
+
+    # Only endpoints whose next poll is due are polled; the others keep
+    # their last result if it was a success
+    to_poll = []
+    owned = [endpoint for endpoint in endpoints if owner_of(endpoint['ip']) == REPLICA_ID]
+    for endpoint in owned:
         ip = endpoint['ip']
-        endpoint_url = f"http://{ip}/runner-info/json"
-        try:
-            print(f"Trying to connect to {endpoint_url}...")
-            response = requests.get(endpoint_url, timeout=5)
-            print(f"Response from {endpoint_url}: status={response.status_code}")
-            
-            if response.status_code == 200:
-                try:
-                    print(f"Content from {endpoint_url}: {response.text[:200]}...")
-                    runner_data = response.json()
-                    
-                    # Add the IP to the runner data
-                    runner_data['ip'] = ip
-                    
-                    runners.append(runner_data)
-                    print(f"Successfully parsed JSON from {endpoint_url}")
-                except json.JSONDecodeError as e:
-                    print(f"Error parsing JSON from {endpoint_url}: {e}")
-                    print(f"Raw content: {response.text}")
-            else:
-                print(f"Error polling {endpoint_url}: HTTP {response.status_code}")
-        except Exception as e:
-            print(f"Error connecting to {endpoint_url}: {e}")
+        state = poll_state.get(ip)
+        if force or state is None or started >= state['next_poll']:
+            if state is not None and state['circuit'] == 'open':
+                state['circuit'] = 'half-open'
+            to_poll.append(endpoint)
+        elif state['ok'] and ip in endpoint_cache:
+            fresh[ip] = endpoint_cache[ip]['data']
+
+    futures = {discovery_executor.submit(fetch_runner, endpoint): endpoint['ip']
+               for endpoint in to_poll}
+    failed = []
+    try:
+        for future in as_completed(futures, timeout=CYCLE_DEADLINE):
+            runner_data, runner_changed = future.result()
+            ip = futures[future]
+            record_poll(ip, runner_data is not None, runner_changed)
+            if runner_data is None:
+                failed.append(ip)
+                continue
+            changed = changed or runner_changed
+            runner_seen[ip] = time.monotonic()
+            fresh[ip] = runner_data
+            partial[ip] = runner_data
+            with state_lock:
+                discovered_runners = sorted(partial.values(), key=lambda r: order[r['ip']])
+    except FuturesTimeoutError:
+        pending = [ip for f, ip in futures.items() if not f.done()]
+        log.warning("Discovery cycle deadline of %ss exceeded, skipping %d endpoint(s): %s",
+                    CYCLE_DEADLINE, len(pending), ', '.join(pending))
+        for f in futures:
+            f.cancel()
+        for ip in pending:
+            record_poll(ip, False, False)
+        failed.extend(pending)
     
-    # Update global state
-    discovered_runners = runners
-    last_updated = time.strftime("%Y-%m-%d %H:%M:%S")
+    # A runner is confirmed gone once it failed again in a full cycle; until
+    # then a failure schedules one, as guard_shrink does on the leader
+    full = len(to_poll) == len(owned)
+    confirm = False
+    for ip in failed:
+        if full and poll_state[ip]['failures'] >= 2:
+            confirmed_gone.add(ip)
+        elif ip not in confirmed_gone:
+            confirm = True
+    confirmed_gone = {ip for ip in confirmed_gone if ip not in fresh and owner_of(ip) == REPLICA_ID and ip in order}
+    if confirm and REPLICATION:
+        refresh_scheduler.trigger('confirm missing runners')
+
+    with state_lock:
+        if REPLICATION:
+            # Runners polled by the other replicas come from their shards
+            changed = merge_shared_runners(endpoints, fresh) or changed
+        
+        # Prefer the cached copy, which includes deltas pushed during the cycle
+        runners = [endpoint_cache[ip]['data'] if ip in endpoint_cache else data
+                   for ip, data in fresh.items()]
+        runners.sort(key=lambda r: order[r['ip']])
+
+        # A runner appearing or disappearing is a change even if its content is cached
+        changed = changed or previous_ips != [r['ip'] for r in runners]
+
+        # Drop state of endpoints that were removed
+        for ip in set(poll_state) | set(endpoint_cache):
+            if ip not in order:
+                endpoint_cache.pop(ip, None)
+                service_debug.pop(ip, None)
+                runner_seen.pop(ip, None)
+                poll_state.pop(ip, None)
+                push_capable.discard(ip)
+        
+        if changed:
+            build_service_index(runners)
+
+        # Update global state
+        discovered_runners = runners
+        discovery_changed = changed
+        last_cycle_full = full
+        if to_poll:
+            last_updated = time.strftime("%Y-%m-%d %H:%M:%S")
     
+    if to_poll:
+        elapsed = time.monotonic() - started
+        DISCOVERY_CYCLE_SECONDS.observe(elapsed)
+        log.info("Polled %d of %d owned endpoints in %.2fs, %d available", len(to_poll), len(owned), elapsed, len(runners),
+                 extra={"polled": len(to_poll), "owned": len(owned), "runners": len(runners), "seconds": round(elapsed, 3)})
+
     return runners
 
-def generate_config(runners):
-    # Start with an empty configuration structure
-    config = {
-        "http": {
-            "routers": {},
-            "services": {}
-        }
-    }
+def shard_filename(runner_name):
+    """Name of the dynamic config file holding a runner's routes"""
+    safe_name = re.sub(r'[^A-Za-z0-9_.-]', '_', runner_name or 'default')
+    return f"{SHARD_PREFIX}{safe_name}.yml"
+
+def write_if_changed(filename, content):
+    """Atomically write content to OUTPUT_DIR/filename unless it is unchanged.
+
+    Returns True if the file was written.
+    """
+    path = os.path.join(OUTPUT_DIR, filename)
+    data = content.encode()
+    digest = hashlib.sha1(data).hexdigest()
+
+    if filename not in written_shards and os.path.exists(path):
+        # First write since startup, compare against what is already on disk
+        with open(path, 'rb') as f:
+            written_shards[filename] = hashlib.sha1(f.read()).hexdigest()
+    if written_shards.get(filename) == digest:
+        return False
+
+    # Write to a hidden temp file and rename it into place so Traefik's
+    # file watcher never sees a partially written file
+    atomic_write(path, data)
+
+    written_shards[filename] = digest
+    return True
+
+def remove_shard(filename):
+    path = os.path.join(OUTPUT_DIR, filename)
+    if os.path.exists(path):
+        os.unlink(path)
+        log.info("Removed stale configuration %s", filename)
+    written_shards.pop(filename, None)
+
+def host_slug(host):
+    """Router/service name prefix for a host served by several runners"""
+    return re.sub(r'[^A-Za-z0-9-]', '-', host)
+
+def route_backend(route):
+    """Name of the load balancer of one (runner, service) route in its runner's shard"""
+    return f"{route['service']}-{route['runner']}-service"
+
+def shared_backend(slug, route):
+    """Name of the load balancer of one route behind a shared host.
+
+    It differs from route_backend() because the route's other hosts may
+    still be routed from its runner's shard, and Traefik service names are
+    global across files.
+    """
+    return f"{slug}-{route['service']}-{route['runner']}-backend"
+
+def add_route(key, route):
+    """Insert a route into the routing table and its host/shard indexes"""
+    routes[key] = route
+    shard_routes.setdefault(shard_filename(route['runner']), set()).add(key)
+    for host in route['hosts']:
+        backends = host_routes.setdefault(host, set())
+        backends.add(key)
+        if len(backends) > 1:
+            shared_hosts.add(host)
+
+def drop_route(key):
+    """Remove a route from the routing table and its host/shard indexes"""
+    route = routes.pop(key)
+    filename = shard_filename(route['runner'])
+    shard_routes[filename].discard(key)
+    if not shard_routes[filename]:
+        del shard_routes[filename]
+    for host in route['hosts']:
+        backends = host_routes[host]
+        backends.discard(key)
+        if len(backends) < 2:
+            shared_hosts.discard(host)
+        if not backends:
+            del host_routes[host]
+    return route
+
+def update_routes(runners, rebuild=False):
+    """Apply the routes of changed runners to the routing table, journaling each change.
+
+    Runners are compared by identity with the ones the table was built
+    from, so only runners whose data was replaced are diffed, service by
+    service. Returns the shard files whose content may have changed, all
+    of them if rebuild is set. Must be called with state_lock held.
+    """
+    global routing_version, routes_published
+    version = routing_version
+    present = {runner['ip']: runner for runner in runners}
+    changed = [runner for ip, runner in present.items() if route_runners.get(ip) is not runner]
+    removed = [ip for ip in route_runners if ip not in present]
     
-    # For each runner
-    for runner in runners:
-        runner_name = runner['runner']  # Either 'default' or 'staging' or other name
-        runner_ip = runner['ip']
+    dirty = set()
+    touched_hosts = set()
+    for ip, runner in [(ip, None) for ip in removed] + [(runner['ip'], runner) for runner in changed]:
+        new_routes = {}
+        for service in (runner or {}).get('services') or []:
+            new_routes[(ip, service['name'])] = {
+                "ip": ip,
+                "runner": runner['runner'],
+                "service": service['name'],
+                "fullDomain": service.get('fullDomain'),
+                "hosts": service_hosts(service)
+            }
         
-        # For each service on this runner
-        if 'services' in runner and runner['services']:
-            for service in runner['services']:
-                service_name = service['name']
-                service_domain = service['fullDomain']
-                
-                # Create unique router and service names using both runner and service name
-                # This prevents services with the same name on different runners from overwriting each other
-                router_name = f"{service_name}-{runner_name}-router"
-                service_backend_name = f"{service_name}-{runner_name}-service"
-                
-                # Create router for this specific service
-                config["http"]["routers"][router_name] = {
-                    "rule": f"Host(`{service_domain}`)",
-                    "service": service_backend_name,
-                    "entryPoints": ["websecure", "web"]
-                }
-                
-                # Create service for this specific service
-                config["http"]["services"][service_backend_name] = {
-                    "loadBalancer": {
-                        "servers": [{"url": f"http://{runner_ip}:80"}]
-                    }
-                }
-                
-                print(f"Added route for {service_domain} to {runner_ip}")
+        old_keys = runner_route_keys.get(ip, set())
+        for key in sorted(old_keys | set(new_routes)):
+            old, new = routes.get(key), new_routes.get(key)
+            if old == new:
+                continue
+            for route in (old, new):
+                if route is not None:
+                    dirty.add(shard_filename(route['runner']))
+                    touched_hosts.update(route['hosts'])
+                    if any(host in shared_hosts for host in route['hosts']):
+                        dirty.add(SHARED_SHARD)
+            if old is not None:
+                drop_route(key)
+            if new is not None:
+                add_route(key, new)
+            routing_version += 1
+            routing_journal.append({
+                "version": routing_version,
+                "op": "add" if old is None else "remove" if new is None else "update",
+                "ip": ip,
+                "service": key[1],
+                "route": new,
+                "time": time.time()
+            })
+        
+        if runner is None:
+            route_runners.pop(ip, None)
+            runner_route_keys.pop(ip, None)
+        else:
+            route_runners[ip] = runner
+            runner_route_keys[ip] = set(new_routes)
+    
+    # A host gaining or losing a second backend moves between its runners'
+    # shards and SHARED_SHARD, so their shards change too
+    for host in touched_hosts:
+        if host in shared_hosts:
+            dirty.add(SHARED_SHARD)
+        for key in host_routes.get(host, ()):
+            dirty.add(shard_filename(routes[key]['runner']))
     
-    # Write the combined configuration to a single file
-    output_file = os.path.join(OUTPUT_DIR, "services.yml")
-    with open(output_file, 'w') as f:
-        yaml.dump(config, f)
-    print(f"Generated configuration with {len(config['http']['routers'])} service routes")
+    if routing_version != version:
+        routes_published = (routing_version, tuple(routing_journal), list(routes.values()))
+    if rebuild:
+        dirty |= set(shard_routes) | set(shard_configs) | {SHARED_SHARD}
+    return dirty
 
-def discovery_thread():
-    while True:
-        print("Discovering runners...")
-        runners = discover_runners()
-        print(f"Found {len(runners)} runners")
+def build_runner_shard(filename):
+    """Routers of the hosts served by only one runner, for the runners writing to filename"""
+    config = {"http": {"routers": {}, "services": {}}}
+    for key in sorted(shard_routes.get(filename, ())):
+        route = routes[key]
+        own_hosts = [host for host in route['hosts'] if host not in shared_hosts]
+        if not own_hosts:
+            continue
         
-        generate_config(runners)
+        # Create unique router and service names using both runner and service name
+        # This prevents services with the same name on different runners from overwriting each other
+        service_backend_name = route_backend(route)
+        config["http"]["routers"][f"{route['service']}-{route['runner']}-router"] = {
+            "rule": " || ".join(f"Host(`{host}`)" for host in own_hosts),
+            "service": service_backend_name,
+            "entryPoints": ["websecure", "web"]
+        }
+        config["http"]["services"][service_backend_name] = {
+            "loadBalancer": {
+                "servers": [{"url": f"http://{route['ip']}:80"}]
+            }
+        }
+    return config
+
+def build_shared_shard():
+    """Routers of the hosts served by several runners, each in front of a weighted round
+    robin over one health-checked load balancer per runner"""
+    config = {"http": {"routers": {}, "services": {}}}
+    for host in sorted(shared_hosts):
+        slug = host_slug(host)
+        weighted = []
+        for key in sorted(host_routes[host]):
+            route = routes[key]
+            load_balancer = {"servers": [{"url": f"http://{route['ip']}:80"}]}
+            if HEALTHCHECK_PATH:
+                load_balancer["healthCheck"] = {
+                    "path": HEALTHCHECK_PATH,
+                    "interval": HEALTHCHECK_INTERVAL,
+                    "timeout": HEALTHCHECK_TIMEOUT,
+                    "hostname": host
+                }
+            backend = shared_backend(slug, route)
+            config["http"]["services"][backend] = {"loadBalancer": load_balancer}
+            weighted.append({"name": backend, "weight": endpoint_capacity(route['ip'])})
         
-        # Notify all connected clients of the update
-        socketio.emit('config_updated', {
-            'timestamp': time.strftime("%Y-%m-%d %H:%M:%S"),
-            'runner_count': len(runners)
+        weighted_service = {"services": weighted}
+        if HEALTHCHECK_PATH:
+            # Let unhealthy runners drop out of the rotation
+            weighted_service["healthCheck"] = {}
+        config["http"]["services"][f"{slug}-service"] = {"weighted": weighted_service}
+        config["http"]["routers"][f"{slug}-router"] = {
+            "rule": f"Host(`{host}`)",
+            "service": f"{slug}-service",
+            "entryPoints": ["websecure", "web"]
+        }
+    return config
+
+def generate_config(runners, rebuild=False):
+    """Update the routing table from runners and rewrite the shard files it changed.
+
+    Hosts served by one runner go to that runner's file, shared hosts to
+    SHARED_SHARD. With rebuild every shard is regenerated and files of
+    runners that are gone are removed from OUTPUT_DIR.
+    """
+    build_started = time.monotonic()
+    dirty = update_routes(runners, rebuild)
+    
+    built = {}
+    for filename in dirty:
+        config = build_shared_shard() if filename == SHARED_SHARD else build_runner_shard(filename)
+        if config["http"]["routers"]:
+            built[filename] = config
+    
+    write_started = time.monotonic()
+    CONFIG_BUILD_SECONDS.observe(write_started - build_started)
+    
+    # Write only the shards whose content changed, and remove the ones left empty
+    written = 0
+    for filename in sorted(dirty):
+        config = built.get(filename)
+        if config is None:
+            shard_configs.pop(filename, None)
+            remove_shard(filename)
+            continue
+        shard_configs[filename] = config
+        if write_if_changed(filename, yaml.dump(config, Dumper=YamlDumper)):
+            written += 1
+            log.info("Wrote %s with %d service routes", filename, len(config['http']['routers']))
+    
+    if rebuild:
+        # Remove shards of runners that are gone, and the old single-file output
+        for filename in os.listdir(OUTPUT_DIR):
+            is_shard = filename == SHARED_SHARD or (filename.startswith(SHARD_PREFIX) and filename.endswith('.yml'))
+            if is_shard and filename not in shard_configs:
+                remove_shard(filename)
+        remove_shard(LEGACY_OUTPUT_FILE)
+    
+    CONFIG_WRITE_SECONDS.observe(time.monotonic() - write_started)
+    runlog.log_change(log, 'traefik-config', "Traefik configuration changed", shard_configs)
+    route_count = sum(len(config['http']['routers']) for config in shard_configs.values())
+    ROUTES_EMITTED.set(route_count)
+    log.info("Generated configuration with %d service routes across %d files (%d rebuilt, %d changed), routing version %d",
+             route_count, len(shard_configs), len(dirty), written, routing_version,
+             extra={"routes": route_count, "files": len(shard_configs), "rebuilt": len(dirty),
+                    "changed": written, "routing_version": routing_version})
+
+def guard_shrink(runners, full):
+    """Hold back runners that dropped out of discovery until a full cycle confirms it.
+
+    A runner that was in the last generated config but is missing from this
+    result (unreachable, timed out) is kept in the config and a forced cycle
+    is scheduled; only when a later full cycle still misses it is it dropped.
+    Runners polled by another replica are only dropped once their owner
+    confirms them gone in its shard (shared_gone), since our full cycles do
+    not poll them. Endpoints removed by the user are dropped right away.
+    Returns the runners to generate the config from. Must be called with
+    state_lock held.
+    """
+    global pending_shrink, written_runners
+    order = {endpoint['ip']: i for i, endpoint in enumerate(load_endpoints())}
+    present = {r['ip'] for r in runners}
+    missing = {ip for ip in written_runners if ip not in present and ip in order}
+    
+    confirmed = {ip for ip in missing
+                 if (full and ip in pending_shrink if owner_of(ip) == REPLICA_ID else ip in shared_gone)}
+    held = missing - confirmed
+    if confirmed:
+        log.warning("Confirmed runners gone, removing their routes: %s", ', '.join(sorted(confirmed)))
+    if held - pending_shrink:
+        log.warning("Runners missing, keeping their routes until confirmed: %s", ', '.join(sorted(held - pending_shrink)))
+        if any(owner_of(ip) == REPLICA_ID for ip in held - pending_shrink):
+            refresh_scheduler.trigger('confirm missing runners')
+    pending_shrink = held
+    
+    result = list(runners) + [written_runners[ip] for ip in held]
+    result.sort(key=lambda r: order.get(r['ip'], len(order)))
+    written_runners = {r['ip']: r for r in result}
+    return result
+
+def write_config(runners, full):
+    """Generate the Traefik config from runners and persist them as the warm-start state.
+
+    Must be called with state_lock held.
+    """
+    global config_dirty, state_runners
+    config_runners = guard_shrink(runners, full)
+    # Endpoint edits (capacities) and a new leader regenerate every shard
+    generate_config(config_runners, rebuild=config_dirty)
+    state_runners = config_runners
+    state_save_requested.set()
+    config_dirty = False
+
+def state_saver_thread():
+    """Persist the warm-start state off the request and discovery paths.
+
+    Config writes only request a save; this writes STATE_FILE at most once
+    per STATE_SAVE_INTERVAL, from the latest runners. The document is
+    assembled under state_lock but serialized and written outside it.
+    """
+    while True:
+        state_save_requested.wait()
+        time.sleep(STATE_SAVE_INTERVAL)
+        state_save_requested.clear()
+        with state_lock:
+            state = state_document(state_runners)
+        save_state(state)
+
+def state_document(runners):
+    """The runners behind the current config, with their ETags. Must be called with state_lock held."""
+    return {
+        "saved_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "runners": [
+            {
+                "data": runner,
+                "etag": endpoint_cache.get(runner['ip'], {}).get('etag'),
+                "digest": endpoint_cache.get(runner['ip'], {}).get('digest'),
+                "debug": service_debug.get(runner['ip'])
+            }
+            for runner in runners
+        ]
+    }
+
+def save_state(state):
+    """Write a state_document() to STATE_FILE"""
+    try:
+        atomic_write(STATE_FILE, json.dumps(state).encode())
+    except Exception as e:
+        log.error("Error saving state: %s", e)
+
+def load_state():
+    """Restore the last saved runners so the dashboard and APIs have data right away.
+
+    The restored data is marked stale until the first full discovery cycle.
+    """
+    global discovered_runners, last_updated, state_stale, written_runners
+    try:
+        with open(STATE_FILE, 'r') as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return
+    except Exception as e:
+        log.error("Error loading state: %s", e)
+        return
+    
+    runners = []
+    for entry in state.get('runners', []):
+        ip = entry['data']['ip']
+        service_debug[ip] = {name: index_debug(debug) for name, debug in (entry.get('debug') or {}).items()}
+        runner = compact_runner(entry['data'], ip)
+        endpoint_cache[runner['ip']] = {"etag": entry.get('etag'), "digest": entry.get('digest'), "data": runner}
+        runners.append(runner)
+    
+    with state_lock:
+        discovered_runners = runners
+        written_runners = {r['ip']: r for r in runners}
+        last_updated = state.get('saved_at')
+        state_stale = True
+        build_service_index(runners)
+    log.info("Restored %d runners from %s (saved %s)", len(runners), STATE_FILE, last_updated)
+
+def slim_runner(runner_data):
+    """The subset of a runner's data shown on the dashboard"""
+    return {
+        "ip": runner_data['ip'],
+        "runner": runner_data.get('runner') or '',
+        "domain": runner_data.get('domain'),
+        "services": {
+            service['name']: {
+                "name": service['name'],
+                "fullDomain": service.get('fullDomain'),
+                "container": service.get('container'),
+                "status": service.get('status')
+            }
+            for service in runner_data.get('services') or []
+        }
+    }
+
+def runner_payload(slim):
+    return dict(slim, services=list(slim['services'].values()))
+
+def dashboard_snapshot():
+    """The current versioned dashboard snapshot, read from dashboard_published without locking"""
+    version, runners = dashboard_published
+    return {
+        "version": version,
+        "timestamp": last_updated,
+        "stale": state_stale,
+        "runners": runners
+    }
+
+def broadcast_runner_changes(runners):
+    """Send connected dashboards only what changed since the last broadcast.
+
+    Runners are compared by identity with the data last sent, so only
+    runners whose data was replaced are diffed, and dashboard_state is
+    patched in place. Must be called with state_lock held.
+    """
+    global dashboard_version, dashboard_published
+    present = {r['ip']: r for r in runners}
+    added, changed = [], []
+    removed = [ip for ip in dashboard_state if ip not in present]
+    for ip in removed:
+        del dashboard_state[ip]
+        dashboard_sources.pop(ip, None)
+        dashboard_payloads.pop(ip, None)
+    
+    for ip, runner_data in present.items():
+        if dashboard_sources.get(ip) is runner_data:
+            continue
+        dashboard_sources[ip] = runner_data
+        slim = slim_runner(runner_data)
+        old = dashboard_state.get(ip)
+        if old == slim:
+            continue
+        dashboard_state[ip] = slim
+        dashboard_payloads[ip] = runner_payload(slim)
+        if old is None:
+            added.append(dashboard_payloads[ip])
+        else:
+            changed.append({
+                "ip": ip,
+                "runner": slim['runner'],
+                "domain": slim['domain'],
+                "added_services": [svc for name, svc in slim['services'].items() if name not in old['services']],
+                "changed_services": [svc for name, svc in slim['services'].items()
+                                     if name in old['services'] and old['services'][name] != svc],
+                "removed_services": [name for name in old['services'] if name not in slim['services']]
+            })
+    
+    if added or changed or removed:
+        dashboard_version += 1
+        dashboard_published = (dashboard_version, [dashboard_payloads[ip] for ip in present])
+        socketio.emit('runners_delta', {
+            "version": dashboard_version,
+            "base_version": dashboard_version - 1,
+            "timestamp": last_updated,
+            "order": list(present),
+            "added_runners": added,
+            "changed_runners": changed,
+            "removed_runners": removed
         })
-        
-        time.sleep(POLLING_INTERVAL)
+    
+    socketio.emit('config_updated', {
+        'timestamp': last_updated,
+        'runner_count': len(runners),
+        'stale': state_stale,
+        'routing_version': routing_version
+    })
+
+@socketio.on('connect')
+def on_connect():
+    """Give each new dashboard the current versioned snapshot"""
+    SOCKETIO_CLIENTS.inc()
+    emit('runners_snapshot', dashboard_snapshot())
+
+@socketio.on('disconnect')
+def on_disconnect():
+    SOCKETIO_CLIENTS.dec()
+
+@socketio.on('request_snapshot')
+def on_request_snapshot():
+    """Sent by dashboards that missed a delta"""
+    emit('runners_snapshot', dashboard_snapshot())
+
+def run_refresh_cycle(cycle):
+    """One discovery + config generation cycle, run by refresh_scheduler"""
+    global state_stale
+    # Periodic ticks only poll the endpoints that are due, triggered cycles poll all
+    previous_update = last_updated
+    runners = discover_runners(force=cycle['reasons'] != ['periodic'])
+    
+    with state_lock:
+        if REPLICATION:
+            publish_shard(discovered_runners)
+        if is_leader() and (discovery_changed or config_dirty or pending_shrink):
+            log.info("Found %d runners", len(runners))
+            write_config(discovered_runners, last_cycle_full)
+        elif not is_leader() and discovery_changed:
+            # Followers keep their routing table current for /api/routes
+            update_routes(discovered_runners)
+        if last_cycle_full:
+            state_stale = False
+        if discovery_changed:
+            broadcast_runner_changes(discovered_runners)
+        elif last_updated != previous_update:
+            # Notify all connected clients that runners were polled
+            socketio.emit('config_updated', {
+                'timestamp': last_updated,
+                'runner_count': len(runners),
+                'stale': state_stale,
+                'routing_version': routing_version
+            })
+    
+    return len(runners)
+
+def is_leader():
+    """Whether this registry may write Traefik config; standalone registries always do"""
+    return not REPLICATION or time.time() < leader_until
+
+def owner_of(ip, members=None):
+    """The replica that polls an endpoint: highest rendezvous hash over the live replicas.
+
+    Only the endpoints of a replica that joins or leaves change owner.
+    """
+    if not REPLICATION:
+        return REPLICA_ID
+    return max(members or replica_members, key=lambda member: hashlib.sha1(f"{member}|{ip}".encode()).digest())
+
+def renew_lease():
+    """Take or extend the leader lease in LEADER_LEASE_FILE.
+
+    The lease is read and written under an exclusive flock, so only one
+    replica can hold it; the holder only rewrites it once less than half
+    of LEADER_LEASE_TTL is left. Returns its expiry if we hold it, else 0.
+    """
+    with open(LEADER_LEASE_FILE, 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.seek(0)
+            try:
+                lease = json.loads(f.read() or '{}')
+            except ValueError:
+                lease = {}
+            now = time.time()
+            if lease.get('holder') not in (None, REPLICA_ID) and lease.get('expires', 0) > now:
+                return 0
+            if lease.get('holder') == REPLICA_ID and lease.get('expires', 0) - now > LEADER_LEASE_TTL / 2:
+                return lease['expires']
+            expires = now + LEADER_LEASE_TTL
+            f.truncate(0)
+            f.write(json.dumps({"holder": REPLICA_ID, "url": REPLICA_URL, "expires": expires}))
+            f.flush()
+            return expires
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def read_members(now):
+    """Live replicas from the heartbeat files, removing those long gone"""
+    members = {}
+    for name in os.listdir(REPLICA_DIR):
+        if not name.endswith('.member.json'):
+            continue
+        path = os.path.join(REPLICA_DIR, name)
+        try:
+            with open(path, 'r') as f:
+                member = json.load(f)
+        except (OSError, ValueError):
+            continue
+        age = now - member.get('heartbeat', 0)
+        if age <= REPLICA_TTL:
+            members[member['id']] = member.get('url')
+        elif age > REPLICA_TTL * 10:
+            # Its runner shard is no use as a fallback any more either
+            for stale in (path, os.path.join(REPLICA_DIR, f"{member['id']}.runners.json")):
+                try:
+                    os.remove(stale)
+                except OSError:
+                    pass
+    return members
+
+def replication_thread():
+    """Heartbeat, track the live replicas and hold or contend for the leader lease"""
+    global leader_until, replica_members, replica_urls, config_dirty
+    os.makedirs(REPLICA_DIR, exist_ok=True)
+    while True:
+        try:
+            now = time.time()
+            atomic_write(os.path.join(REPLICA_DIR, f"{REPLICA_ID}.member.json"),
+                         json.dumps({"id": REPLICA_ID, "url": REPLICA_URL, "heartbeat": now}).encode())
+            members = read_members(now)
+            members[REPLICA_ID] = REPLICA_URL
+            replica_urls = members
+            if sorted(members) != replica_members:
+                log.info("Replicas: %s", ', '.join(sorted(members)))
+                replica_members = sorted(members)
+                refresh_scheduler.trigger('replicas changed')
+            
+            was_leader = is_leader()
+            leader_until = renew_lease()
+            if is_leader() and not was_leader:
+                log.info("Replica %s is now the leader, writing Traefik config", REPLICA_ID)
+                with state_lock:
+                    config_dirty = True
+                refresh_scheduler.trigger('became leader')
+            elif was_leader and not is_leader():
+                log.warning("Replica %s lost the leader lease", REPLICA_ID)
+        except Exception as e:
+            log.error("Error in replication heartbeat: %s", e)
+        time.sleep(REPLICA_HEARTBEAT)
+
+def publish_shard(runners):
+    """Share the runners this replica polls with the other replicas.
+
+    Must be called with state_lock held.
+    """
+    global published_shard_digest
+    shard = {
+        "runners": {r['ip']: {"data": r, "debug": service_debug.get(r['ip'])}
+                    for r in runners if owner_of(r['ip']) == REPLICA_ID},
+        "gone": sorted(confirmed_gone)
+    }
+    body = json.dumps(shard, sort_keys=True).encode()
+    digest = hashlib.sha1(body).hexdigest()
+    if digest == published_shard_digest:
+        return
+    try:
+        atomic_write(os.path.join(REPLICA_DIR, f"{REPLICA_ID}.runners.json"), body)
+        published_shard_digest = digest
+    except Exception as e:
+        log.error("Error publishing runner shard: %s", e)
+
+def read_shared_runners():
+    """Runners published by the other replicas, keyed by ip.
+
+    Shard files are only re-read when their mtime changes. If two shards
+    hold the same runner (its owner just changed), the current owner's wins.
+    Also updates shared_gone from the runners each owner confirmed gone.
+    """
+    global shared_gone
+    shared = {}
+    gone = set()
+    try:
+        names = os.listdir(REPLICA_DIR)
+    except FileNotFoundError:
+        shared_gone = gone
+        return shared
+    for name in names:
+        member = name[:-len('.runners.json')]
+        if not name.endswith('.runners.json') or member == REPLICA_ID:
+            continue
+        path = os.path.join(REPLICA_DIR, name)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+            cached = shared_shards.get(member)
+            if cached is None or cached[0] != mtime:
+                with open(path, 'rb') as f:
+                    shard = json.load(f)
+                entries = {ip: dict(entry, digest=hashlib.sha1(json.dumps(entry, sort_keys=True).encode()).hexdigest())
+                           for ip, entry in shard.get('runners', {}).items()}
+                cached = shared_shards[member] = (mtime, entries, set(shard.get('gone', [])))
+        except (OSError, ValueError, AttributeError) as e:
+            log.warning("Error reading runner shard %s: %s", name, e)
+            continue
+        for ip, entry in cached[1].items():
+            if ip not in shared or owner_of(ip) == member:
+                shared[ip] = entry
+        gone.update(ip for ip in cached[2] if owner_of(ip) == member)
+    shared_gone = gone
+    return shared
+
+def merge_shared_runners(endpoints, fresh):
+    """Add the runners of endpoints we do not own to fresh, from the other replicas' shards.
+
+    Returns whether any of them changed. Must be called with state_lock held.
+    """
+    changed = False
+    shared = read_shared_runners()
+    for endpoint in endpoints:
+        ip = endpoint['ip']
+        if owner_of(ip) == REPLICA_ID or ip not in shared:
+            continue
+        entry = shared[ip]
+        cached = endpoint_cache.get(ip)
+        if cached is None or cached.get('shared') != entry['digest']:
+            service_debug[ip] = entry.get('debug') or {}
+            # No ETag: if this replica takes the endpoint over it polls it in full
+            endpoint_cache[ip] = {"etag": None, "digest": None,
+                                  "data": compact_runner(entry['data'], ip), "shared": entry['digest']}
+            changed = True
+        fresh[ip] = endpoint_cache[ip]['data']
+    return changed
+
+def forward_delta(ip, delta):
+    """Hand a pushed delta to the replica that polls its runner, without waiting for it.
+
+    A delta that fails to arrive leaves a sequence gap, so the owner
+    resyncs the runner with a full poll on its next delta.
+    """
+    owner = owner_of(ip)
+    url = replica_urls.get(owner)
+    if not url:
+        return jsonify({"status": "error", "message": f"Replica {owner} owning {ip} is unknown"}), 503
+    forward_executor.submit(post_forwarded_delta, owner, url, dict(delta, ip=ip))
+    return jsonify({"status": "forwarded", "owner": owner})
+
+def post_forwarded_delta(owner, url, delta):
+    try:
+        response = http_session.post(f"{url}/api/ingest", json=delta,
+                                     headers={'X-Registry-Forwarded': REPLICA_ID},
+                                     timeout=(ENDPOINT_CONNECT_TIMEOUT, ENDPOINT_READ_TIMEOUT))
+        if response.status_code not in (200, 202):
+            log.warning("Replica %s answered forwarded delta %d from %s with HTTP %d",
+                        owner, delta['seq'], delta['ip'], response.status_code)
+    except Exception as e:
+        log.warning("Error forwarding delta %d from %s to replica %s: %s", delta['seq'], delta['ip'], owner, e)
+
+def known_access_host(host):
+    """Whether an access log host belongs to a service, exactly or through a HostRegexp.
+
+    Results of lookup_host() are kept in a bounded LRU that is dropped
+    whenever the host index is swapped. Only called from access_log_thread.
+    """
+    global access_host_index
+    if host in host_index:
+        return True
+    if access_host_index is not host_patterns:
+        access_host_cache.clear()
+        access_host_index = host_patterns
+    known = access_host_cache.get(host)
+    if known is None:
+        known = access_host_cache[host] = bool(lookup_host(host))
+        if len(access_host_cache) > ACCESS_HOST_CACHE:
+            access_host_cache.popitem(last=False)
+    else:
+        access_host_cache.move_to_end(host)
+    return known
+
+def parse_access_lines(lines):
+    """(host, status, duration_ms) of Traefik JSON access log lines.
+
+    Hosts that are not a known service are folded into OTHER_HOST so that
+    scanners and typos cannot take up the tracked host slots.
+    """
+    requests_seen = []
+    errors = 0
+    for line in lines:
+        try:
+            entry = json.loads(line)
+            host = (entry.get('RequestHost') or '').lower()
+            status = int(entry.get('DownstreamStatus') or 0)
+            ms = (entry.get('Duration') or 0) / 1e6  # nanoseconds
+        except (ValueError, TypeError, AttributeError):
+            errors += 1
+            continue
+        requests_seen.append((host if known_access_host(host) else OTHER_HOST, status, ms))
+    return requests_seen, errors
+
+def access_log_thread():
+    """Follow ACCESS_LOG_FILE like tail -F and feed traffic_stats.
+
+    Reads in ACCESS_LOG_CHUNK blocks and only keeps an incomplete last line
+    between reads. Starts at the end of the file and reopens it from the
+    start after it is rotated or truncated.
+    """
+    f = None
+    position = 0
+    partial = b''
+    start_at_end = True  # skip what was logged before the registry started
+    while True:
+        try:
+            if f is None:
+                f = open(ACCESS_LOG_FILE, 'rb')
+                if start_at_end:
+                    f.seek(0, os.SEEK_END)
+                    start_at_end = False
+                position = f.tell()
+                log.info("Following access log %s from byte %d", ACCESS_LOG_FILE, position)
+            
+            chunk = f.read(ACCESS_LOG_CHUNK)
+            if chunk:
+                position += len(chunk)
+                lines = (partial + chunk).split(b'\n')
+                partial = lines.pop()
+                requests_seen, errors = parse_access_lines(line for line in lines if line)
+                traffic_stats.record_many(requests_seen, time.time())
+                ACCESS_LOG_LINES.inc(len(requests_seen))
+                if errors:
+                    ACCESS_LOG_ERRORS.inc(errors)
+                continue
+            
+            # At the end: check for rotation (new file) or truncation (copytruncate)
+            current = os.stat(ACCESS_LOG_FILE)
+            if current.st_ino != os.fstat(f.fileno()).st_ino or current.st_size < position:
+                log.info("Access log %s was rotated, reopening", ACCESS_LOG_FILE)
+                f.close()
+                f = open(ACCESS_LOG_FILE, 'rb')
+                position = 0
+                partial = b''
+                continue
+        except FileNotFoundError:
+            if f is not None:
+                f.close()
+                f = None
+                position = 0
+                partial = b''
+        except Exception as e:
+            log.error("Error following access log: %s", e)
+        time.sleep(ACCESS_LOG_IDLE)
 
 def main():
     os.makedirs(OUTPUT_DIR, exist_ok=True)
@@ -338,12 +2376,24 @@ def main():
     # Don't generate templates dynamically
     # Just use the external templates provided
     
-    # Start discovery in a background thread
-    t = threading.Thread(target=discovery_thread, daemon=True)
+    # Serve the last known state until the first discovery cycle completes
+    load_state()
+    
+    # Start the refresh scheduler, which also runs the periodic discovery
+    t = threading.Thread(target=refresh_scheduler.run, daemon=True)
     t.start()
     
+    if ACCESS_LOG_FILE:
+        threading.Thread(target=access_log_thread, daemon=True).start()
+    
+    if REPLICATION:
+        threading.Thread(target=replication_thread, daemon=True).start()
+    
+    threading.Thread(target=ingest_thread, daemon=True).start()
+    threading.Thread(target=state_saver_thread, daemon=True).start()
+    
     # Start the web server with WebSocket support
-    socketio.run(app, host='0.0.0.0', port=5000, debug=False)
+    socketio.run(app, host='0.0.0.0', port=REGISTRY_PORT, debug=False)
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -1,25 +1,135 @@
 #!/usr/bin/env python3
 import os
+import sys
 import json
+import logging
 import time
 import docker
 import threading
 import socket
 import requests
 import yaml
-from flask import Flask, jsonify, render_template_string
+import hashlib
+import re
+import uuid
+import tempfile
+import gzip
+from collections import OrderedDict, deque
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from flask import Flask, Response, jsonify, request
+from waitress import serve
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
+try:
+    import runlog
+except ImportError:
+    # Running from a checkout, where the shared modules live in Templates/shared
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir, 'shared'))
+    import runlog
 
 # Configuration
 RUNNER_NAME = os.environ.get('RUNNER', 'default')
 DOMAIN_FULL = os.environ.get('DOMAIN_FULL', 'preview.tafu.casa')
-REFRESH_INTERVAL = 30  # seconds
+# Discovery follows the Docker events stream; a full reconciliation runs this often
+RECONCILE_INTERVAL = int(os.environ.get('RECONCILE_INTERVAL', '300'))  # seconds
+TRAEFIK_API = os.environ.get('TRAEFIK_API', 'http://traefik:8080')
+ROUTING_FILE = os.environ.get('ROUTING_FILE', "/etc/traefik/dynamic/services-generated.yml")
+SINK_RETRY_INTERVAL = 10  # seconds between retries of a routing sink that failed
+HTTP_THREADS = int(os.environ.get('HTTP_THREADS', '8'))
+EVENT_DEBOUNCE = 0.2  # seconds to let a burst of container events settle before publishing
+CONTAINER_EVENTS = ['start', 'stop', 'die', 'rename', 'destroy']
+# Registry to push service deltas to, e.g. http://registry.preview.tafu.casa (empty disables pushing)
+REGISTRY_URL = os.environ.get('REGISTRY_URL', '').rstrip('/')
+# Address the registry knows this runner by (its endpoint ip)
+RUNNER_IP = os.environ.get('RUNNER_IP', '')
+# Identifies this process so the registry can tell a restart from a sequence gap
+RUNNER_EPOCH = uuid.uuid4().hex
+# Last published services, restored on startup so /json answers before Docker does
+STATE_FILE = os.environ.get('STATE_FILE', '/var/lib/runner-info/state.json')
+STARTUP_RETRY_INTERVAL = 5  # seconds between reconcile attempts while Docker is unavailable
+# Container resource telemetry from the Docker stats stream
+STATS_SAMPLE_INTERVAL = float(os.environ.get('STATS_SAMPLE_INTERVAL', '5'))  # seconds between kept samples
+STATS_HISTORY = int(os.environ.get('STATS_HISTORY', '60'))  # samples kept per container
+# Also sample the other containers of each entry point's compose project
+STATS_SIBLINGS = os.environ.get('STATS_SIBLINGS', 'false').lower() in ('1', 'true', 'yes')
+STATS_FIELDS = ('time', 'cpu_percent', 'memory_bytes', 'memory_limit_bytes',
+                'net_rx_rate', 'net_tx_rate', 'blk_read_rate', 'blk_write_rate')
+# Traefik v2 router rules: the matchers whose arguments are extracted, and the
+# tokens of the rule language (matcher calls, strings, operators and parentheses)
+RULE_MATCHERS = {'Host': 'hosts', 'HostHeader': 'hosts', 'HostRegexp': 'hostRegexps',
+                 'Path': 'paths', 'PathPrefix': 'pathPrefixes'}
+RULE_TOKEN = re.compile(r'(?P<matcher>[A-Za-z]+)\s*\(|(?P<string>`[^`]*`|"(?:[^"\\]|\\.)*")'
+                        r'|(?P<operator>&&|\|\||!)|(?P<open>\()|(?P<close>\))|(?P<comma>,)|(?P<space>\s+)|(?P<error>.)')
+RULE_CACHE_SIZE = 1024  # distinct label sets whose parsed routers are kept
+
+# Logging is configured from LOG_LEVEL, LOG_FORMAT and the other LOG_* variables, see runlog
+runlog.configure()
+log = logging.getLogger('runner-info')
+
+# Metrics exposed on /metrics
+DISCOVERY_CYCLE_SECONDS = Histogram('runner_info_discover_services_seconds',
+                                    'Duration of a discover_services cycle')
+CONFIG_BUILD_SECONDS = Histogram('runner_info_routing_table_build_seconds',
+                                 'Time to build the routing table in build_routing_table')
+CONFIG_WRITE_SECONDS = Histogram('runner_info_routing_file_write_seconds',
+                                 'Time to serialize and write the routing table to the file sink')
+TRAEFIK_PUT_SECONDS = Histogram('runner_info_traefik_rest_put_seconds',
+                                'Latency of the PUT to the Traefik REST provider')
+DOCKER_API_CALLS = Counter('runner_info_docker_api_calls_total',
+                           'Docker API calls made during discovery', ['call'])
+ROUTES_EMITTED = Gauge('runner_info_routes', 'Routes in the generated Traefik config')
 
 # Global state
 services = []
 last_updated = None
+stale = False  # True while serving services restored from STATE_FILE
+
+# Entry-point services keyed by container id, kept current from Docker events
+service_map = {}
+# Container name -> IP, resolved from the same container data as service_map
+container_ips = {}
+service_map_lock = threading.Lock()
+services_dirty = threading.Event()  # set when service_map changed
+reconcile_requested = threading.Event()  # set when events may have been missed
+
+# Resource samples per container id: {"name", "service", "samples"}, where samples
+# is a ring buffer of STATS_FIELDS tuples; stats_collectors holds the stop flag of
+# each container's collector thread
+container_stats = {}
+stats_collectors = {}
+container_stats_lock = threading.Lock()
+# Sibling containers sampled along with the entry points: id -> (name, service name)
+stats_siblings = {}
+
+# Pre-serialized /json and / documents (plain and gzipped), swapped atomically
+# whenever discovery output changes
+json_snapshot = {"etag": None, "body": b"", "body_gz": b"", "html": b"", "html_gz": b"", "version": 0}
+
+# Shared session for pushes to the registry
+push_session = requests.Session()
+
+# Pooled session for the bridge Traefik API, retrying transient failures with backoff
+traefik_session = requests.Session()
+traefik_session.mount('http://', HTTPAdapter(max_retries=Retry(
+    total=3,
+    backoff_factor=0.5,
+    status_forcelist=[502, 503, 504],
+    allowed_methods=['GET', 'PUT']
+)))
+
+# Parsed routers keyed by the set of a container's router labels, least recently used first
+router_cache = OrderedDict()
+router_cache_lock = threading.Lock()
+
+# Long-lived Docker client shared by all threads, created on first use
+docker_client = None
+docker_client_lock = threading.Lock()
 
 app = Flask(__name__)
 
+# Compiled index.html, loaded on first use
+index_template = None
+
 def get_template():
     """Read the HTML template from file"""
     template_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'index.html')
@@ -27,267 +137,828 @@ def get_template():
         with open(template_path, 'r') as f:
             return f.read()
 
-@app.route('/')
-def index():
-    """Serve the HTML view"""
-    template = get_template()
-    json_data = json.dumps(services, indent=2)
-    return render_template_string(
-        template,
+def render_index(services, last_updated):
+    """Render the HTML view with the template compiled once"""
+    global index_template
+    if index_template is None:
+        index_template = app.jinja_env.from_string(get_template() or "")
+    return index_template.render(
         runner=RUNNER_NAME,
         domain=DOMAIN_FULL,
         last_updated=last_updated or "Never",
         services=services,
-        json_data=json_data
+        json_data=json.dumps(services, indent=2)
     )
 
+def snapshot_response(body, body_gz, mimetype):
+    """Serve a pre-serialized body, gzipped if the client accepts it"""
+    if 'gzip' in request.accept_encodings:
+        response = Response(body_gz, mimetype=mimetype)
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = Response(body, mimetype=mimetype)
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+def current_snapshot():
+    snapshot = json_snapshot
+    if snapshot["etag"] is None:
+        # Nothing discovered yet, build a snapshot from the current state
+        update_snapshot(services)
+        snapshot = json_snapshot
+    return snapshot
+
+@app.route('/')
+def index():
+    """Serve the HTML view"""
+    snapshot = current_snapshot()
+    return snapshot_response(snapshot["html"], snapshot["html_gz"], 'text/html')
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus metrics"""
+    return Response(generate_latest(), mimetype=CONTENT_TYPE_LATEST)
+
+@app.route('/stats')
+def get_stats():
+    """Container resource telemetry from the ring buffers; ?history=0 for current values only"""
+    return jsonify(stats_report(history=request.args.get('history') != '0'))
+
 @app.route('/json')
 def get_json():
-    """Serve the JSON API"""
+    """Serve the JSON API from the pre-serialized snapshot"""
+    snapshot = current_snapshot()
+    
+    if request.args.get('stats'):
+        # Telemetry changes every sample, so it is never part of the cached snapshot
+        runner_info = json.loads(snapshot["body"])
+        runner_info["stats"] = stats_report(history=request.args.get('history') != '0')
+        return jsonify(runner_info)
+    
+    # Both encodings share the snapshot's ETag
+    if request.if_none_match.contains(snapshot["etag"]):
+        response = Response(status=304)
+        response.headers['Vary'] = 'Accept-Encoding'
+    else:
+        response = snapshot_response(snapshot["body"], snapshot["body_gz"], 'application/json')
+    response.set_etag(snapshot["etag"])
+    return response
+
+def update_snapshot(services):
+    """Rebuild the /json and / snapshot if the discovered services changed.
+
+    Returns True when a new snapshot (and ETag) was published.
+    """
+    global json_snapshot
+    # The epoch is part of the ETag, so a restarted runner-info never answers
+    # 304 to a registry that still holds the previous process's epoch
+    digest = hashlib.sha1(json.dumps([RUNNER_EPOCH, services, stale], sort_keys=True).encode()).hexdigest()
+    if digest == json_snapshot["etag"]:
+        return False
+
+    version = json_snapshot["version"] + 1
     runner_info = {
         "runner": RUNNER_NAME,
         "domain": DOMAIN_FULL,
         "services": services,
-        "last_updated": last_updated
+        "last_updated": last_updated,
+        "stale": stale,
+        "version": version,
+        "epoch": RUNNER_EPOCH
+    }
+    body = json.dumps(runner_info).encode()
+    html = render_index(services, last_updated).encode()
+    json_snapshot = {
+        "etag": digest,
+        "body": body,
+        "body_gz": gzip.compress(body),
+        "html": html,
+        "html_gz": gzip.compress(html),
+        "version": version
     }
-    return jsonify(runner_info)
+    return True
 
-def get_container_ip(container_name):
-    """Get the IP address of a container on the bridge network"""
+def push_delta(previous, current):
+    """Push the difference between two service lists to the registry.
+
+    The delta is numbered with the snapshot version; the registry accepts it
+    with 202 and applies it only if it directly follows the version it
+    already has, otherwise it resyncs by polling /json, so a failed push
+    only delays the update.
+    """
+    if not REGISTRY_URL:
+        return
+    
+    previous_by_name = {service["name"]: service for service in previous}
+    current_by_name = {service["name"]: service for service in current}
+    snapshot = json_snapshot
+    delta = {
+        "runner": RUNNER_NAME,
+        "ip": RUNNER_IP,
+        "epoch": RUNNER_EPOCH,
+        "seq": snapshot["version"],
+        "etag": snapshot["etag"],
+        "last_updated": last_updated,
+        "added": [service for name, service in current_by_name.items() if name not in previous_by_name],
+        "changed": [service for name, service in current_by_name.items()
+                    if name in previous_by_name and previous_by_name[name] != service],
+        "removed": [name for name in previous_by_name if name not in current_by_name]
+    }
+    
     try:
-        # Use Docker API to get container details
-        client = docker.from_env()
-        container = client.containers.get(container_name)
-        
-        # Look for the bridge-network IP
-        networks = container.attrs["NetworkSettings"]["Networks"]
-        for network_name, network_config in networks.items():
-            if network_name == "bridge-network":
-                return network_config["IPAddress"]
-        
-        # If no bridge-network IP found, return the first IP
-        if networks:
-            return list(networks.values())[0]["IPAddress"]
-        
-        return None
+        response = push_session.post(f"{REGISTRY_URL}/api/ingest", json=delta, timeout=5)
+        if response.status_code == 409:
+            log.info("Registry requested a resync for delta %d", delta['seq'])
+        elif response.status_code not in (200, 202):
+            log.warning("Error pushing delta %d: HTTP %d", delta['seq'], response.status_code)
     except Exception as e:
-        print(f"Error getting container IP for {container_name}: {e}", flush=True)
+        log.warning("Error pushing delta to registry: %s", e)
+
+def get_docker_client():
+    """Return the shared Docker client"""
+    global docker_client
+    with docker_client_lock:
+        if docker_client is None:
+            docker_client = docker.from_env()
+        return docker_client
+
+def container_ip(networks):
+    """IP address of a container on the bridge network, from its NetworkSettings.Networks"""
+    # Look for the bridge-network IP
+    for network_name, network_config in networks.items():
+        if network_name == "bridge-network":
+            return network_config["IPAddress"]
+    
+    # If no bridge-network IP found, return the first IP
+    if networks:
+        return list(networks.values())[0]["IPAddress"]
+    
+    return None
+
+def get_container_ip(container_name):
+    """Get the IP address of a container on the bridge network.
+
+    IPs come from the last container listing or event, so this makes no
+    Docker API call.
+    """
+    ip = container_ips.get(container_name)
+    if not ip:
+        log.warning("No IP known for container %s", container_name)
+    return ip
+
+def compile_rule(rule):
+    """Parse a Traefik v2 router rule into the hosts, host regexps, paths and path prefixes it matches.
+
+    Matchers under a negation are left out. Raises ValueError on a malformed rule.
+    """
+    tokens = [(match.lastgroup, match.group(match.lastgroup))
+              for match in RULE_TOKEN.finditer(rule) if match.lastgroup != 'space']
+    compiled = {key: [] for key in RULE_MATCHERS.values()}
+    position = 0
+    
+    def take(kind=None):
+        nonlocal position
+        if position >= len(tokens):
+            raise ValueError(f"unexpected end of rule {rule!r}")
+        token_kind, value = tokens[position]
+        if kind and token_kind != kind:
+            raise ValueError(f"unexpected {value!r} in rule {rule!r}")
+        position += 1
+        return token_kind, value
+    
+    def expression(negated):
+        term(negated)
+        while position < len(tokens) and tokens[position][1] in ('&&', '||'):
+            take()
+            term(negated)
+    
+    def term(negated):
+        kind, value = take()
+        if kind == 'operator' and value == '!':
+            term(not negated)
+        elif kind == 'open':
+            expression(negated)
+            take('close')
+        elif kind == 'matcher':
+            arguments = []
+            while True:
+                _, argument = take('string')
+                arguments.append(argument[1:-1] if argument[0] == '`' else json.loads(argument))
+                separator, _ = take()
+                if separator == 'close':
+                    break
+                if separator != 'comma':
+                    raise ValueError(f"expected ',' or ')' in rule {rule!r}")
+            if not negated and value in RULE_MATCHERS:
+                values = compiled[RULE_MATCHERS[value]]
+                values.extend(a for a in arguments if a not in values)
+        else:
+            raise ValueError(f"unexpected {value!r} in rule {rule!r}")
+    
+    expression(False)
+    if position != len(tokens):
+        raise ValueError(f"unexpected {tokens[position][1]!r} in rule {rule!r}")
+    return compiled
+
+def parse_router_labels(labels):
+    """Routers declared in a container's Traefik labels, in label order.
+
+    Each is {"router", "priority", "hosts", "hostRegexps", "paths",
+    "pathPrefixes"}, with Traefik's default priority (the rule length) when
+    no priority label is set. Results are memoized on the router labels, so
+    containers whose labels did not change are not parsed again.
+    """
+    key = frozenset(item for item in labels.items() if item[0].startswith('traefik.http.routers.'))
+    with router_cache_lock:
+        routers = router_cache.get(key)
+        if routers is not None:
+            router_cache.move_to_end(key)
+            return routers
+    
+    routers = []
+    for label, rule in labels.items():
+        parts = label.split('.')
+        if len(parts) != 5 or not label.startswith('traefik.http.routers.') or parts[4] != 'rule':
+            continue
+        try:
+            router = compile_rule(rule)
+        except ValueError as e:
+            log.warning("Ignoring router %s: %s", parts[3], e)
+            continue
+        try:
+            priority = int(labels.get(f"traefik.http.routers.{parts[3]}.priority", len(rule)))
+        except ValueError:
+            priority = len(rule)
+        routers.append(dict(router, router=parts[3], priority=priority))
+    
+    with router_cache_lock:
+        router_cache[key] = routers
+        while len(router_cache) > RULE_CACHE_SIZE:
+            router_cache.popitem(last=False)
+    return routers
+
+def listed_container(entry):
+    """(name, labels, status, networks) of a container from a /containers/json list entry.
+
+    Names holds the container's name and the names it is linked under
+    (which contain another slash), each with a leading slash.
+    """
+    names = entry.get('Names') or ['/']
+    name = next((name[1:] for name in names if '/' not in name[1:]), names[0][1:])
+    networks = (entry.get('NetworkSettings') or {}).get('Networks') or {}
+    return name, entry.get('Labels') or {}, entry.get('State'), networks
+
+def inspected_container(container):
+    """(name, labels, status, networks) of an inspected docker-py Container"""
+    return container.name, container.labels, container.status, container.attrs["NetworkSettings"]["Networks"]
+
+def service_from_container(name, labels, status, networks):
+    """Build the service record of an entry-point container, or None for other containers"""
+    # Look for our service entry-point label
+    if labels.get('com.runner.service.type') != 'entry-point' or 'com.runner.service.name' not in labels:
         return None
+    
+    service_name = labels['com.runner.service.name']
+    
+    # Get the hosts of all routers from the traefik labels if available
+    routers = parse_router_labels(labels)
+    domains = []
+    for router in routers:
+        domains.extend(host for host in router['hosts'] if host not in domains)
+    domain = domains[0] if domains else None
+    
+    # Check if we found domains in labels
+    if domains:
+        # The first host becomes fullDomain, prefixed with the service name unless
+        # it already contains it; the other hosts are routed exactly as written
+        full_domain = domain if domain.startswith(f"{service_name}.") else f"{service_name}.{domain}"
+        hosts = list(dict.fromkeys([full_domain] + domains[1:]))
+    else:
+        # Fallback to constructed domain if not found in labels
+        runner = os.environ.get('RUNNER', '')
+        domain_base = os.environ.get('DOMAIN_FULL', 'preview.tafu.casa')
+        if runner:
+            domain = f"{runner}.{domain_base}"
+        else:
+            domain = domain_base
+        domain = domain.replace("..", ".")
+        full_domain = f"{service_name}.{domain}"
+        hosts = [full_domain]
+    
+    # Make sure the Host rule in bridge traefik includes the complete domains
+    router_rule = " || ".join(f"Host(`{host}`)" for host in hosts)
+    
+    return {
+        "name": service_name,
+        "container": name,
+        "fullDomain": full_domain,
+        "hosts": hosts,
+        "status": status,
+        "routerRule": router_rule,
+        "debug": {
+            "labels": {key: value for key, value in labels.items() if "traefik" in key},
+            "routers": routers,
+            "originalDomain": domain,
+            "networks": list(networks)
+        }
+    }
 
-def discover_services():
-    """Discover all services running in Docker with their domains."""
-    discovered_services = []
+def discover_service_map():
+    """Discover all entry-point services from a full container listing.
+
+    Returns (services keyed by container id, IPs keyed by container name),
+    both built from a single list call, or (None, None) if Docker could not
+    be listed. The low-level API is used because docker-py's
+    containers.list() inspects every container it lists.
+    """
+    discovered = {}
+    ips = {}
     
     try:
-        client = docker.from_env()
-        containers = client.containers.list()
-        
-        # Filter for entry point containers using explicit labels
-        for container in containers:
-            labels = container.labels
-            
-            # Look for our service entry-point label
-            if 'com.runner.service.name' in labels and 'com.runner.service.type' in labels:
-                if labels['com.runner.service.type'] == 'entry-point':
-                    service_name = labels['com.runner.service.name']
-                    
-                    # Get routing rule from traefik labels if available
-                    domain = None
-                    for label, value in labels.items():
-                        if 'rule' in label and 'Host(' in value:
-                            try:
-                                # Extract domain from Host rule
-                                domain = value.split('Host(`')[1].split('`)')[0]
-                                break
-                            except:
-                                pass
-                    
-                    # Check if we found domain in labels
-                    if domain:
-                        # If domain already contains the service name, don't duplicate it
-                        if domain.startswith(f"{service_name}."):
-                            full_domain = domain
-                        else:
-                            full_domain = f"{service_name}.{domain}"
-                    else:
-                        # Fallback to constructed domain if not found in labels
-                        runner = os.environ.get('RUNNER', '')
-                        domain_base = os.environ.get('DOMAIN_FULL', 'preview.tafu.casa')
-                        if runner:
-                            domain = f"{runner}.{domain_base}"
-                        else:
-                            domain = domain_base
-                        domain = domain.replace("..", ".")
-                        full_domain = f"{service_name}.{domain}"
-                    
-                    # Make sure the Host rule in bridge traefik includes the complete domain
-                    router_rule = f"Host(`{full_domain}`)"
-                    
-                    # Add service to discovered list
-                    discovered_services.append({
-                        "name": service_name,
-                        "container": container.name,
-                        "fullDomain": full_domain,
-                        "status": container.status,
-                        "routerRule": router_rule,
-                        "debug": {
-                            "labels": {key: value for key, value in labels.items() if "traefik" in key},
-                            "originalDomain": domain,
-                            "networks": [net for net in container.attrs["NetworkSettings"]["Networks"]]
-                        }
-                    })
+        client = get_docker_client()
+        DOCKER_API_CALLS.labels('containers.list').inc()
+        # Let the Docker daemon filter for entry point containers
+        entries = client.api.containers(filters={'label': 'com.runner.service.type=entry-point'})
         
-        # Sort services by name for consistent display
-        discovered_services.sort(key=lambda x: x["name"])
+        for entry in entries:
+            name, labels, status, networks = listed_container(entry)
+            service = service_from_container(name, labels, status, networks)
+            if service:
+                discovered[entry['Id']] = service
+                ips[name] = container_ip(networks)
         
     except Exception as e:
-        print(f"Error discovering services: {e}", flush=True)
+        log.error("Error discovering services: %s", e)
+        return None, None
     
-    return discovered_services
+    return discovered, ips
 
-def register_services_with_traefik(services):
-    """Register discovered services with the Traefik REST provider"""
-    try:
-        # Create router configurations for each service
-        dynamic_config = {
-            "http": {
-                "routers": {},
-                "services": {}
-            }
-        }
-        
-        for service in services:
-            service_name = service["name"]
-            service_domain = service["fullDomain"]
-            service_ip = get_container_ip(service["container"])
-            
-            print(f"Container {service['container']} has IP: {service_ip}", flush=True)
-            
-            # Skip if we couldn't get the IP
-            if not service_ip:
-                print(f"Skipping {service_name} - could not get IP", flush=True)
-                continue
-                
-            router_name = f"auto-{service_name}"
-            
-            # Create router for this service
-            dynamic_config["http"]["routers"][router_name] = {
-                "rule": f"Host(`{service_domain}`)",
-                "service": router_name,
-                "entryPoints": ["web"]
-            }
-            
-            # Create service pointing to the container
-            dynamic_config["http"]["services"][router_name] = {
-                "loadBalancer": {
-                    "servers": [{"url": f"http://{service_ip}:80"}]
-                }
-            }
-        
-        # Post to Traefik REST provider
-        traefik_url = "http://traefik:8080/api/providers/rest"
-        print(f"Sending config to Traefik: {json.dumps(dynamic_config)}", flush=True)
-        response = requests.put(traefik_url, json=dynamic_config)
-        print(f"Traefik API response: {response.status_code} {response.text}", flush=True)
+def discover_services():
+    """Discover all services running in Docker with their domains."""
+    # Sort services by name for consistent display
+    discovered, _ = discover_service_map()
+    return sorted((discovered or {}).values(), key=lambda x: x["name"])
+
+def handle_container_event(client, event):
+    """Apply a single Docker container event to service_map"""
+    container_id = event.get('id') or event.get('Actor', {}).get('ID')
+    action = event.get('Action') or event.get('status')
+    if not container_id:
+        return
+    
+    service = None
+    ip = None
+    if action in ('start', 'rename'):
+        try:
+            DOCKER_API_CALLS.labels('containers.get').inc()
+            name, labels, status, networks = inspected_container(client.containers.get(container_id))
+            service = service_from_container(name, labels, status, networks)
+            ip = container_ip(networks)
+        except docker.errors.NotFound:
+            pass
+    
+    with service_map_lock:
+        old = service_map.get(container_id)
+        if service:
+            if old == service and container_ips.get(service["container"]) == ip:
+                return
+            if old:
+                container_ips.pop(old["container"], None)
+            service_map[container_id] = service
+            container_ips[service["container"]] = ip
+        elif old is None:
+            return
+        else:
+            del service_map[container_id]
+            container_ips.pop(old["container"], None)
+    
+    log.info("Container %s %s, updating services", container_id[:12], action)
+    services_dirty.set()
+
+def events_thread():
+    """Background thread following the Docker events stream"""
+    while True:
+        try:
+            client = get_docker_client()
+            DOCKER_API_CALLS.labels('events').inc()
+            events = client.events(decode=True, filters={
+                'type': 'container',
+                'event': CONTAINER_EVENTS,
+                'label': 'com.runner.service.type=entry-point'
+            })
+            for event in events:
+                handle_container_event(client, event)
+        except Exception as e:
+            log.error("Error following Docker events: %s", e)
         
-    except Exception as e:
-        print(f"Error registering services: {e}", flush=True)
+        # Events may have been missed while the stream was down
+        reconcile_requested.set()
+        services_dirty.set()
+        time.sleep(5)
 
 def check_traefik_status():
     """Check Traefik status and available routers/services"""
     try:
         # Try to get Traefik API status
-        response = requests.get("http://traefik:8080/api/http/routers")
+        response = traefik_session.get(f"{TRAEFIK_API}/api/http/routers", timeout=5)
         if response.status_code == 200:
             routers = response.json()
-            print(f"Traefik has {len(routers)} routers configured", flush=True)
-            for router in routers:
-                print(f"Router: {router['name']}, Rule: {router['rule']}", flush=True)
+            log.debug("Traefik has %d routers configured", len(routers))
+            runlog.log_change(log, 'traefik-routers', "Traefik routers changed",
+                              {router['name']: router['rule'] for router in routers})
         else:
-            print(f"Could not get Traefik routers: {response.status_code}", flush=True)
+            log.warning("Could not get Traefik routers: HTTP %d", response.status_code)
     except Exception as e:
-        print(f"Error checking Traefik status: {e}", flush=True)
+        log.warning("Error checking Traefik status: %s", e)
 
-def discovery_thread():
-    """Background thread that periodically discovers services"""
-    global services, last_updated
-    while True:
-        print("Discovering services...", flush=True)
-        discovered = discover_services()
-        services = discovered
+def publish_services(full):
+    """Publish service_map as the current services and re-emit routing config.
+
+    After an event the config is only re-emitted if the services changed or
+    a sink still has to accept it; a full reconciliation always rebuilds it.
+    """
+    global services, last_updated, stale
+    with service_map_lock:
+        current = sorted(service_map.values(), key=lambda x: x["name"])
+    
+    if current == services and not full and not sinks_pending():
+        return
+    
+    if current != services or full:
+        previous = services
+        services = current
+        # Whatever was restored from STATE_FILE has now been confirmed or replaced
+        stale = False
         last_updated = time.strftime("%Y-%m-%d %H:%M:%S")
-        print(f"Found {len(services)} services", flush=True)
-        # Generate dynamic configuration file based on discovered services
-        generate_traefik_config(services)
-        # Register discovered services with Traefik
-        register_services_with_traefik(services)
+        log.info("Found %d services", len(services), extra={"services": len(services)})
+        if update_snapshot(services):
+            log.info("Published snapshot version %d", json_snapshot['version'])
+            push_delta(previous, services)
+            save_state()
+    # Build one routing table and hand it to the sinks whose copy is outdated
+    table = build_routing_table(services)
+    if publish_routing_table(table, full):
         # Check Traefik status for debugging
         check_traefik_status()
-        time.sleep(REFRESH_INTERVAL)
 
-def generate_traefik_config(services):
-    """Generate Traefik dynamic configuration file from discovered services"""
+def save_state():
+    """Persist the published services and container IPs to STATE_FILE"""
+    with service_map_lock:
+        ips = dict(container_ips)
+    state = {"saved_at": last_updated, "services": services, "container_ips": ips}
     try:
-        # Create base config structure
-        config = {
-            "http": {
-                "routers": {},
-                "services": {}
-            }
+        directory = os.path.dirname(STATE_FILE)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".state.", suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, STATE_FILE)
+    except Exception as e:
+        log.error("Error saving state: %s", e)
+
+def load_state():
+    """Restore the last published services, marked stale until Docker confirms them"""
+    global services, container_ips, last_updated, stale
+    try:
+        with open(STATE_FILE, 'r') as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return
+    except Exception as e:
+        log.error("Error loading state: %s", e)
+        return
+    
+    services = state.get("services", [])
+    last_updated = state.get("saved_at")
+    stale = True
+    with service_map_lock:
+        container_ips = state.get("container_ips", {})
+    update_snapshot(services)
+    log.info("Restored %d services from %s (saved %s)", len(services), STATE_FILE, last_updated)
+
+def stats_sample(raw, previous):
+    """Turn one Docker stats document into a STATS_FIELDS tuple.
+
+    previous holds the (time, rx, tx, read, write) counters of the last kept
+    sample, from which the network and block IO rates are derived. Returns
+    the sample and the counters to pass next time.
+    """
+    cpu = raw.get('cpu_stats') or {}
+    precpu = raw.get('precpu_stats') or {}
+    cpu_delta = (cpu.get('cpu_usage') or {}).get('total_usage', 0) - (precpu.get('cpu_usage') or {}).get('total_usage', 0)
+    system_delta = (cpu.get('system_cpu_usage') or 0) - (precpu.get('system_cpu_usage') or 0)
+    cpus = cpu.get('online_cpus') or len((cpu.get('cpu_usage') or {}).get('percpu_usage') or []) or 1
+    cpu_percent = cpu_delta / system_delta * cpus * 100 if system_delta > 0 and cpu_delta > 0 else 0.0
+    
+    # Page cache is reclaimable, leave it out like `docker stats` does
+    memory = raw.get('memory_stats') or {}
+    memory_detail = memory.get('stats') or {}
+    memory_bytes = (memory.get('usage') or 0) - memory_detail.get('inactive_file', memory_detail.get('cache', 0))
+    
+    networks = (raw.get('networks') or {}).values()
+    io = (raw.get('blkio_stats') or {}).get('io_service_bytes_recursive') or []
+    now = time.time()
+    counters = (
+        now,
+        sum(network.get('rx_bytes', 0) for network in networks),
+        sum(network.get('tx_bytes', 0) for network in networks),
+        sum(entry.get('value', 0) for entry in io if entry.get('op', '').lower() == 'read'),
+        sum(entry.get('value', 0) for entry in io if entry.get('op', '').lower() == 'write')
+    )
+    if previous and counters[0] > previous[0]:
+        elapsed = counters[0] - previous[0]
+        rates = [round(max(0, current - last) / elapsed) for current, last in zip(counters[1:], previous[1:])]
+    else:
+        rates = [0, 0, 0, 0]
+    
+    sample = (int(now), round(cpu_percent, 2), max(0, memory_bytes), memory.get('limit'), *rates)
+    return sample, counters
+
+def stats_collector(container_id, stop):
+    """Follow one container's Docker stats stream, keeping a sample every STATS_SAMPLE_INTERVAL.
+
+    The stream ends when the container stops; the thread then exits and a
+    later sync_stats_collectors starts a new one if the container is back.
+    """
+    stream = None
+    previous = None
+    next_sample = 0
+    try:
+        DOCKER_API_CALLS.labels('stats').inc()
+        stream = get_docker_client().api.stats(container_id, decode=True, stream=True)
+        for raw in stream:
+            if stop.is_set():
+                break
+            now = time.monotonic()
+            if now < next_sample:
+                continue
+            next_sample = now + STATS_SAMPLE_INTERVAL
+            sample, previous = stats_sample(raw, previous)
+            with container_stats_lock:
+                entry = container_stats.get(container_id)
+                if entry is None:
+                    break
+                entry["samples"].append(sample)
+    except Exception as e:
+        log.warning("Error following stats of container %s: %s", container_id[:12], e)
+    finally:
+        if stream is not None and hasattr(stream, 'close'):
+            stream.close()
+        with container_stats_lock:
+            if stats_collectors.get(container_id) is stop:
+                del stats_collectors[container_id]
+
+def discover_siblings(discovered):
+    """Containers sharing a compose project with an entry point, with that entry point's service"""
+    siblings = {}
+    try:
+        DOCKER_API_CALLS.labels('containers.list').inc()
+        entries = get_docker_client().api.containers(filters={'label': 'com.docker.compose.project'})
+    except Exception as e:
+        log.warning("Error listing sibling containers: %s", e)
+        return stats_siblings
+    
+    projects = {}
+    for entry in entries:
+        if entry['Id'] in discovered:
+            projects[entry['Labels']['com.docker.compose.project']] = discovered[entry['Id']]["name"]
+    for entry in entries:
+        service_name = projects.get(entry['Labels']['com.docker.compose.project'])
+        if service_name and entry['Id'] not in discovered:
+            siblings[entry['Id']] = (listed_container(entry)[0], service_name)
+    return siblings
+
+def sync_stats_collectors():
+    """Run one stats collector per entry-point (and sibling) container, and no others"""
+    with service_map_lock:
+        targets = {container_id: (service["container"], service["name"]) for container_id, service in service_map.items()}
+    targets.update(stats_siblings)
+    
+    with container_stats_lock:
+        for container_id in [c for c in container_stats if c not in targets]:
+            del container_stats[container_id]
+            stop = stats_collectors.pop(container_id, None)
+            if stop is not None:
+                stop.set()
+        for container_id, (name, service_name) in targets.items():
+            entry = container_stats.setdefault(container_id, {"samples": deque(maxlen=STATS_HISTORY)})
+            entry["name"] = name
+            entry["service"] = service_name
+            if container_id not in stats_collectors:
+                stop = stats_collectors[container_id] = threading.Event()
+                threading.Thread(target=stats_collector, args=(container_id, stop), daemon=True).start()
+
+def stats_report(history=True):
+    """Current values (and history) per container, with totals per service and for the runner"""
+    with container_stats_lock:
+        entries = [(entry["name"], entry["service"], list(entry["samples"])) for entry in container_stats.values()]
+    
+    summed = STATS_FIELDS[1:3] + STATS_FIELDS[4:]
+    load = dict.fromkeys(summed, 0)
+    by_service = {}
+    containers = []
+    for name, service_name, samples in sorted(entries):
+        current = dict(zip(STATS_FIELDS, samples[-1])) if samples else None
+        container = {"container": name, "service": service_name, "current": current}
+        if history:
+            container["history"] = [dict(zip(STATS_FIELDS, sample)) for sample in samples]
+        containers.append(container)
+        if current:
+            service_load = by_service.setdefault(service_name, dict.fromkeys(summed, 0))
+            for field in summed:
+                service_load[field] += current[field]
+                load[field] += current[field]
+    
+    return {
+        "interval": STATS_SAMPLE_INTERVAL,
+        "load": {field: round(value, 2) for field, value in load.items()},
+        "services": {name: {field: round(value, 2) for field, value in service_load.items()}
+                     for name, service_load in by_service.items()},
+        "containers": containers
+    }
+
+def discovery_thread():
+    """Background thread publishing service changes and reconciling periodically"""
+    global service_map, container_ips, stats_siblings
+    next_reconcile = 0
+    reconciled = False
+    while True:
+        full = False
+        if time.monotonic() >= next_reconcile or reconcile_requested.is_set():
+            reconcile_requested.clear()
+            log.debug("Reconciling services")
+            with DISCOVERY_CYCLE_SECONDS.time():
+                discovered, ips = discover_service_map()
+            if discovered is None:
+                # Keep serving the previous services and try again shortly
+                next_reconcile = time.monotonic() + STARTUP_RETRY_INTERVAL
+            else:
+                with service_map_lock:
+                    service_map = discovered
+                    container_ips = ips
+                if STATS_SIBLINGS:
+                    stats_siblings = discover_siblings(discovered)
+                next_reconcile = time.monotonic() + RECONCILE_INTERVAL
+                reconciled = full = True
+        
+        # Nothing is published until Docker has been listed once, so a daemon
+        # that is still starting never replaces the restored services with nothing
+        if reconciled:
+            publish_services(full)
+            sync_stats_collectors()
+        
+        # Sleep until the next reconciliation, a sink retry, or until events changed something
+        timeout = max(0, next_reconcile - time.monotonic())
+        if sinks_pending():
+            timeout = min(timeout, SINK_RETRY_INTERVAL)
+        if services_dirty.wait(timeout=timeout):
+            time.sleep(EVENT_DEBOUNCE)
+            services_dirty.clear()
+
+def build_routing_table(services):
+    """Compile the Traefik dynamic configuration for the discovered services"""
+    build_started = time.monotonic()
+    
+    # Create base config structure
+    config = {
+        "http": {
+            "routers": {},
+            "services": {}
         }
+    }
+    
+    # Add a router and service for each discovered service
+    for service in services:
+        name = service["name"]
+        domain = service["fullDomain"]
+        container = service["container"]
         
-        # Add a router and service for each discovered service
-        for service in services:
-            name = service["name"]
-            domain = service["fullDomain"]
-            container = service["container"]
-            
-            # Skip containers that aren't running
-            if service["status"] != "running":
-                continue
-            
-            # Get the container IP directly
-            service_ip = get_container_ip(container)
-            if not service_ip:
-                print(f"Skipping {name} - could not get IP", flush=True)
-                continue
-            
-            # Create router for this service
-            router_name = f"auto-{name}"
-            config["http"]["routers"][router_name] = {
-                "rule": f"Host(`{domain}`)",
-                "service": router_name,
-                "entryPoints": ["web"],
-                "priority": 100
-            }
-            
-            # Create service pointing to the container
-            config["http"]["services"][router_name] = {
-                "loadBalancer": {
-                    "servers": [{"url": f"http://{service_ip}:80"}],
-                    "passHostHeader": True
-                }
-            }
+        # Skip containers that aren't running
+        if service["status"] != "running":
+            continue
         
-        # Write config to file
-        config_path = "/etc/traefik/dynamic/services-generated.yml"
-        with open(config_path, "w") as f:
-            yaml.dump(config, f, default_flow_style=False)
-        print(f"Generated Traefik config with {len(services)} services at {config_path}", flush=True)
-        print(f"Configuration details: {json.dumps(config, indent=2)}", flush=True)
-    except Exception as e:
-        print(f"Error generating Traefik config: {e}", flush=True)
+        service_ip = get_container_ip(container)
+        if not service_ip:
+            log.warning("Skipping %s - could not get IP", name)
+            continue
+        
+        # Create router for this service, matching all of its hosts
+        router_name = f"auto-{name}"
+        config["http"]["routers"][router_name] = {
+            "rule": " || ".join(f"Host(`{host}`)" for host in service.get("hosts") or [domain]),
+            "service": router_name,
+            "entryPoints": ["web"],
+            "priority": 100
+        }
+        
+        # Create service pointing to the container
+        config["http"]["services"][router_name] = {
+            "loadBalancer": {
+                "servers": [{"url": f"http://{service_ip}:80"}],
+                "passHostHeader": True
+            }
+        }
+    
+    CONFIG_BUILD_SECONDS.observe(time.monotonic() - build_started)
+    ROUTES_EMITTED.set(len(config["http"]["routers"]))
+    return config
+
+class FileSink:
+    """Writes the routing table to the file provider's directory"""
+    name = "file"
+    # The file survives Traefik restarts, so unchanged tables are never rewritten
+    volatile = False
+    
+    def __init__(self, path):
+        self.path = path
+    
+    def emit(self, table):
+        with CONFIG_WRITE_SECONDS.time():
+            # Write to a temp file and rename it so Traefik never reads a partial file
+            directory = os.path.dirname(self.path)
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".services-generated.", suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w") as f:
+                    yaml.dump(table, f, default_flow_style=False)
+                os.chmod(tmp_path, 0o644)
+                os.replace(tmp_path, self.path)
+            except Exception:
+                if os.path.exists(tmp_path):
+                    os.unlink(tmp_path)
+                raise
+        log.info("Generated Traefik config with %d routes at %s", len(table['http']['routers']), self.path,
+                 extra={"routes": len(table['http']['routers'])})
+        runlog.log_change(log, 'routing-table', "Routing table changed", table)
+
+class RestSink:
+    """PUTs the routing table to the Traefik REST provider"""
+    name = "rest"
+    # Traefik forgets REST provider config when it restarts, so full
+    # reconciliations push the table again even if it is unchanged
+    volatile = True
+    
+    def __init__(self, url, session):
+        self.url = url
+        self.session = session
+    
+    def emit(self, table):
+        with TRAEFIK_PUT_SECONDS.time():
+            response = self.session.put(self.url, json=table, timeout=10)
+        if not response.ok:
+            log.warning("Traefik REST provider answered HTTP %d: %s", response.status_code, response.text[:200])
+        response.raise_for_status()
+        log.info("Sent %d routes to the Traefik REST provider", len(table['http']['routers']))
+
+ROUTING_SINKS = [
+    FileSink(ROUTING_FILE),
+    RestSink(f"{TRAEFIK_API}/api/providers/rest", traefik_session)
+]
+
+# Hash of the routing table each sink last accepted, keyed by sink name
+sink_hashes = {}
+# Hash of the most recently built routing table
+table_hash = None
+
+def sinks_pending():
+    """Whether a sink failed to accept the latest routing table"""
+    return table_hash is not None and any(sink_hashes.get(sink.name) != table_hash
+                                          for sink in ROUTING_SINKS)
+
+def publish_routing_table(table, full=False):
+    """Emit the routing table to every sink whose copy differs from it.
+
+    A sink that fails keeps its old hash, so it is retried on the next
+    publish. Returns True if any sink emitted.
+    """
+    global table_hash
+    digest = hashlib.sha1(json.dumps(table, sort_keys=True).encode()).hexdigest()
+    table_hash = digest
+    emitted = False
+    for sink in ROUTING_SINKS:
+        if sink_hashes.get(sink.name) == digest and not (full and sink.volatile):
+            continue
+        try:
+            sink.emit(table)
+            sink_hashes[sink.name] = digest
+            emitted = True
+        except Exception as e:
+            log.error("Error emitting routing table to %s sink: %s", sink.name, e)
+    return emitted
 
 def main():
     # Create templates directory if it doesn't exist
     os.makedirs(os.path.join(os.path.dirname(os.path.abspath(__file__))), exist_ok=True)
     
-    # Start discovery in a background thread
+    # Serve the last published services until the first reconciliation
+    load_state()
+    
+    # Start discovery in background threads
     t = threading.Thread(target=discovery_thread, daemon=True)
     t.start()
+    threading.Thread(target=events_thread, daemon=True).start()
     
-    # Start the web server
-    app.run(host='0.0.0.0', port=80)
+    # Start the multi-threaded production web server
+    serve(app, host='0.0.0.0', port=80, threads=HTTP_THREADS)
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -0,0 +1,169 @@
+"""Structured logging shared by the registry and runner-info.
+
+Records go through a bounded queue to a background thread that formats
+them as JSON lines (or plain text) on stderr, so a slow stdout or Docker log
+driver never blocks the discovery loops. Repetitive messages are rate
+limited per message template, and large documents such as generated
+configs are only dumped at debug level when they change.
+
+Log with %-style arguments, e.g. log.info("Polled %d endpoints", count),
+so records of one call site share a template and are only formatted if
+they are kept. Structured fields are passed with extra={...}.
+"""
+import atexit
+import hashlib
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+
+# Configuration
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json').lower()  # json or text
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', '10000'))  # records waiting to be written before new ones are dropped
+# Each message template may log LOG_RATE_BURST records per LOG_RATE_WINDOW
+# seconds; past that only one in LOG_SAMPLE_EVERY is kept (0 drops them all)
+LOG_RATE_WINDOW = float(os.environ.get('LOG_RATE_WINDOW', '60'))
+LOG_RATE_BURST = int(os.environ.get('LOG_RATE_BURST', '20'))
+LOG_SAMPLE_EVERY = int(os.environ.get('LOG_SAMPLE_EVERY', '100'))
+
+# Attributes of every LogRecord; anything else was passed with extra= and is a field
+RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'taskName'}
+
+# Background writer, started by configure()
+listener = None
+configure_lock = threading.Lock()
+
+# Digest of the last document dumped per key, see log_change()
+dump_digests = {}
+
+def record_fields(record):
+    """The structured fields passed to a record with extra="""
+    return {key: value for key, value in vars(record).items() if key not in RECORD_ATTRIBUTES}
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record: time, level, logger, msg and any fields"""
+    def format(self, record):
+        entry = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "msg": record.getMessage()
+        }
+        entry.update(record_fields(record))
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+class TextFormatter(logging.Formatter):
+    """Human readable lines with the fields appended as key=value"""
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def format(self, record):
+        line = super().format(record)
+        fields = record_fields(record)
+        if fields:
+            line += " " + " ".join(f"{key}={json.dumps(value, default=str)}" for key, value in fields.items())
+        return line
+
+class RateLimitFilter(logging.Filter):
+    """Keep the first `burst` records of each message template per window, then sample.
+
+    Sampled records carry the sampling rate as their "sampled" field, and the
+    first record let through in a new window carries the number of records
+    suppressed in the previous one as its "suppressed" field.
+    """
+    def __init__(self, window, burst, sample_every):
+        super().__init__()
+        self.window = window
+        self.burst = burst
+        self.sample_every = sample_every
+        self.lock = threading.Lock()
+        self.counters = {}  # (logger, level, template) -> [window start, count, suppressed]
+
+    def filter(self, record):
+        key = (record.name, record.levelno, record.msg)
+        now = time.monotonic()
+        with self.lock:
+            counter = self.counters.get(key)
+            if counter is None or now - counter[0] >= self.window:
+                suppressed = counter[2] if counter else 0
+                counter = self.counters[key] = [now, 0, 0]
+                if suppressed:
+                    record.suppressed = suppressed
+            counter[1] += 1
+            excess = counter[1] - self.burst
+            if excess <= 0:
+                return True
+            if self.sample_every and excess % self.sample_every == 0:
+                record.sampled = self.sample_every
+                return True
+            counter[2] += 1
+            return False
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Queue records without ever blocking, dropping them while the queue is full.
+
+    The next record queued after a drop carries the count as its "dropped" field.
+    """
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Merge the arguments now, they may change before the writer formats the record
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        if self.dropped:
+            record.dropped, self.dropped = self.dropped, 0
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+def configure():
+    """Route all logging through the queue to the background writer; safe to call more than once"""
+    global listener
+    with configure_lock:
+        if listener is not None:
+            return
+        stream_handler = logging.StreamHandler(sys.stderr)
+        stream_handler.setFormatter(TextFormatter() if LOG_FORMAT == 'text' else JsonFormatter())
+
+        log_queue = queue.Queue(LOG_QUEUE_SIZE)
+        queue_handler = DroppingQueueHandler(log_queue)
+        queue_handler.addFilter(RateLimitFilter(LOG_RATE_WINDOW, LOG_RATE_BURST, LOG_SAMPLE_EVERY))
+
+        root = logging.getLogger()
+        root.handlers[:] = [queue_handler]
+        root.setLevel(LOG_LEVEL)
+
+        listener = logging.handlers.QueueListener(log_queue, stream_handler)
+        listener.start()
+        # Write out what is still queued on exit
+        atexit.register(listener.stop)
+
+def log_change(logger, key, message, document):
+    """Dump a document at debug level, only if it differs from the last one dumped under key.
+
+    Nothing is serialized unless debug logging is enabled.
+    """
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    body = json.dumps(document, sort_keys=True, default=str)
+    digest = hashlib.sha1(body.encode()).hexdigest()
+    if dump_digests.get(key) == digest:
+        return
+    dump_digests[key] = digest
+    logger.debug(message, extra={"document": document})